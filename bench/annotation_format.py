@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+"""
+Time loading and saving image data in the eepee data format against
+pickle, as older versions saved it (text mode, protocol 0), and with
+the highest pickle protocol.
+The data is a typical annotated image - a note, calibration, crop
+frame, a few calipers and a doodle.
+
+Usage: python bench/annotation_format.py [number of images]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+from annotation_store import encode_data, decode_data, pack_calipers
+from strokes import StrokeList
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+def sample_data():
+    """Image data with some of everything that is saved"""
+    doodle = StrokeList()
+    for stroke in range(5):
+        doodle.append([100 + stroke * 50 + point % 7 for point in range(60)])
+    return {"note" : u'sinus rhythm, first degree AV block',
+            "calibration" : 0.25, "rotation" : 1,
+            "cropframe" : [10, 20, 1500, 900],
+            "calipers" : pack_calipers([(100, 220, 500), (340, 460, 620)]),
+            "doodle" : doodle.tostring()}
+
+
+formats = [('eepee', encode_data, decode_data, 'b'),
+           ('pickle 0', lambda data: pickle.dumps(data), pickle.loads, ''),
+           ('pickle 2', lambda data: pickle.dumps(data, 2), pickle.loads, 'b')]
+
+
+def time_format(encode, decode, mode, directory, data, count):
+    """Seconds per image to save and to load count files"""
+    paths = [os.path.join(directory, '.image%05d' % index)
+             for index in range(count)]
+
+    start = time.time()
+    for path in paths:
+        output = open(path, 'w' + mode)
+        output.write(encode(data))
+        output.close()
+    saving = time.time() - start
+
+    start = time.time()
+    for path in paths:
+        loaded = decode(open(path, 'r' + mode).read())
+    loading = time.time() - start
+
+    assert loaded == data
+    return saving / count, loading / count
+
+
+def main():
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    else:
+        count = 2000
+
+    data = sample_data()
+    for name, encode, decode, mode in formats:
+        directory = tempfile.mkdtemp()
+        try:
+            saving, loading = time_format(encode, decode, mode,
+                                          directory, data, count)
+        finally:
+            shutil.rmtree(directory)
+        print '%-9s %4d bytes, save %.3f ms, load %.3f ms per image' % (
+            name, len(encode(data)), saving * 1000, loading * 1000)
+
+
+if __name__ == "__main__":
+    main()
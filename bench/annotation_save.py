@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+"""
+Time saving image data the way eepee does it.
+Each save writes a data file and hides it. The data file is also saved
+the old way, removing the old file and, on windows, hiding it with an
+attrib process per file, for comparison. On windows the hiding alone
+is timed too, as that is what the attrib process was used for.
+Each timing is the best of a few rounds, as single runs are noisy.
+
+Usage: python bench/annotation_save.py [number of saves] [rounds]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+from annotation_store import write_data, hide_file
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+def old_save(datafile, data):
+    """Save as eepee did before - remove, pickle and run attrib"""
+    if os.path.exists(datafile):
+        os.remove(datafile)
+    pickle.dump(data, open(datafile, 'w'))
+    if sys.platform == 'win32':
+        old_hide(datafile)
+
+
+def old_hide(datafile):
+    """Hide a file as eepee did before, with an attrib process"""
+    os.popen("attrib +h \"%s\"" % (datafile)).close()
+
+
+def time_saves(save, directory, count):
+    """Seconds taken for count saves, each to its own file"""
+    data = {"note" : 'sinus rhythm', "calibration" : 0.25,
+            "rotation" : 1, "cropframe" : [10, 20, 1500, 900]}
+    start = time.time()
+    for index in range(count):
+        save(os.path.join(directory, '.image%05d.eep' % index), data)
+    return time.time() - start
+
+
+def time_hiding(hide, directory, count):
+    """Seconds taken to hide count files that are not hidden yet"""
+    paths = [os.path.join(directory, 'image%05d.eep' % index)
+             for index in range(count)]
+    for path in paths:
+        open(path, 'wb').close()
+    start = time.time()
+    for path in paths:
+        hide(path)
+    return time.time() - start
+
+
+def best(timing, count, rounds):
+    """Fastest of rounds runs of timing(directory, count), in ms
+    per file. Each run gets a new directory"""
+    times = []
+    for round in range(rounds):
+        directory = tempfile.mkdtemp()
+        try:
+            times.append(timing(directory, count))
+        finally:
+            shutil.rmtree(directory)
+    return min(times) * 1000 / count
+
+
+def main():
+    count, rounds = 500, 5
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        rounds = int(sys.argv[2])
+
+    for name, save in [('in process', write_data), ('old', old_save)]:
+        # twice - the second time the files are replaced
+        def saves(directory, count):
+            time_saves(save, directory, count)
+            return time_saves(save, directory, count)
+        created = best(lambda directory, count:
+                       time_saves(save, directory, count), count, rounds)
+        replaced = best(saves, count, rounds)
+        print '%-12s create %.3f ms per save, replace %.3f ms per save' % (
+            name, created, replaced)
+
+    if sys.platform != 'win32':
+        print 'hiding is only timed on windows'
+        return
+    for name, hide in [('in process', hide_file), ('attrib', old_hide)]:
+        print '%-12s hide %.3f ms per file' % (
+            name, best(lambda directory, count:
+                       time_hiding(hide, directory, count), count, rounds))
+
+
+if __name__ == "__main__":
+    main()
@@ -21,7 +21,15 @@ source_files = ['playlist_select.py',
            'config_manager.py',
            'customrubberband.py',
            'fullscreen_help_dialog.py',
-           'ppt_export.py']
+           'ppt_export.py',
+           'image_cache.py',
+           'strokes.py',
+           'tile_pyramid.py',
+           'disk_cache.py',
+           'mapped_image.py',
+           'thumbnails.py',
+           'dirscan.py',
+           'annotation_store.py']
 
 
 share_files = ['eepee.desktop',
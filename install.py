@@ -30,6 +30,14 @@ FILES = (('src/eepee.py', 'share/eepee/eepee.py'),
          ('src/playlist_select.py', 'share/eepee/playlist_select.py'),
          ('src/ppt_export.py', 'share/eepee/ppt_export.py'),
          ('src/fullscreen_help_dialog.py', 'share/eepee/fullscreen_help_dialog.py'),
+         ('src/image_cache.py', 'share/eepee/image_cache.py'),
+         ('src/strokes.py', 'share/eepee/strokes.py'),
+         ('src/tile_pyramid.py', 'share/eepee/tile_pyramid.py'),
+         ('src/disk_cache.py', 'share/eepee/disk_cache.py'),
+         ('src/mapped_image.py', 'share/eepee/mapped_image.py'),
+         ('src/thumbnails.py', 'share/eepee/thumbnails.py'),
+         ('src/dirscan.py', 'share/eepee/dirscan.py'),
+         ('src/annotation_store.py', 'share/eepee/annotation_store.py'),
          ('CHANGES', 'share/eepee/CHANGES'),
          ('LICENSE', 'share/eepee/LICENSE'),
          ('share/eepee.desktop', 'share/applications/eepee.desktop'),
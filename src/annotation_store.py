@@ -0,0 +1,474 @@
+#!/usr/bin/env python
+
+"""
+Saving of the data stored with each image - notes, calibration,
+rotation, crop frame, calipers and doodle.
+The data for an image is saved in a hidden file next to it. Saves are
+handed to a writer thread so that moving to the next image does not
+wait for the disk, which can be slow on network shares.
+
+Data files start with a magic string and a format version, followed by
+the data as tagged little endian values. Unlike a pickle, reading one
+cannot run code, so data files in shared folders are safe to open.
+Older versions saved pickles in a '.pkl' file; these are still read
+when an image has no data file in the current format.
+The data for a whole playlist is loaded into an index in the background,
+so that the data is at hand when moving between images.
+"""
+
+import os
+import sys
+import struct
+import tempfile
+import threading
+
+from dirscan import scan_images
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+## on windows, file attributes are set and files replaced through
+## the windows api, without starting a process or removing the old file
+try:
+    import ctypes
+    kernel32 = ctypes.windll.kernel32
+except (ImportError, AttributeError): # not windows
+    kernel32 = None
+
+FILE_ATTRIBUTE_HIDDEN = 0x2
+INVALID_FILE_ATTRIBUTES = 0xFFFFFFFF
+MOVEFILE_REPLACE_EXISTING = 0x1
+
+if kernel32:
+    kernel32.GetFileAttributesW.restype = ctypes.c_uint32
+
+
+def wide(path):
+    """Path as unicode, as the windows api calls need"""
+    if isinstance(path, unicode):
+        return path
+    return path.decode(sys.getfilesystemencoding() or 'mbcs')
+
+
+def hide_file(path):
+    """Set the hidden attribute on windows. Elsewhere files
+    starting with '.' are hidden already"""
+    if not kernel32:
+        return
+    path = wide(path)
+    attributes = kernel32.GetFileAttributesW(path)
+    if attributes == INVALID_FILE_ATTRIBUTES:
+        return
+    if not attributes & FILE_ATTRIBUTE_HIDDEN:
+        kernel32.SetFileAttributesW(path, attributes | FILE_ATTRIBUTE_HIDDEN)
+
+
+def replace_file(source, destination):
+    """Rename source to destination, replacing destination if it exists"""
+    if not kernel32:
+        os.rename(source, destination) # replaces on posix
+    elif not kernel32.MoveFileExW(wide(source), wide(destination),
+                                  MOVEFILE_REPLACE_EXISTING):
+        raise ctypes.WinError()
+
+
+def pack_calipers(calipers):
+    """Compact encoding of caliper positions, a list of (x1, x2, y2)
+    in world coords - the number of calipers and then the positions
+    as little endian floats"""
+    data = [struct.pack('<I', len(calipers))]
+    for x1, x2, y2 in calipers:
+        data.append(struct.pack('<fff', x1, x2, y2))
+    return ''.join(data)
+
+
+def unpack_calipers(data):
+    """Caliper positions from the encoding made by pack_calipers.
+    Raises FormatError if data is not such an encoding"""
+    if not isinstance(data, str) or len(data) < 4:
+        raise FormatError("damaged calipers")
+    count, = struct.unpack('<I', data[:4])
+    if len(data) != 4 + 12 * count:
+        raise FormatError("damaged calipers")
+    return [struct.unpack('<fff', data[4 + 12 * index:16 + 12 * index])
+            for index in range(count)]
+
+
+MAGIC = 'EEPD'
+FORMAT_VERSION = 1
+header = struct.Struct('<4sH') # magic, format version
+
+
+class FormatError(Exception):
+    """A data file that is damaged or in an unknown format"""
+    pass
+
+
+def data_path(filepath):
+    """Path to the file holding stored data for the image at filepath,
+    same as the image with '.' in front (hidden on Linux) and '.eep'
+    as extension"""
+    return os.path.join(os.path.dirname(filepath),
+                  "."+os.path.splitext(os.path.basename(filepath))[0]+".eep")
+
+
+def legacy_path(filepath):
+    """Path to the pickled data saved by older versions"""
+    return os.path.splitext(data_path(filepath))[0] + ".pkl"
+
+
+def encode_value(value, output):
+    """Append the encoding of value to the list output. Each value
+    is a type tag followed by the packed value"""
+    if value is None:
+        output.append('n')
+    elif isinstance(value, (int, long)): # bools are stored as ints
+        output.append('i' + struct.pack('<q', value))
+    elif isinstance(value, float):
+        output.append('d' + struct.pack('<d', value))
+    elif isinstance(value, str):
+        output.append('s' + struct.pack('<I', len(value)) + value)
+    elif isinstance(value, unicode):
+        value = value.encode('utf-8')
+        output.append('u' + struct.pack('<I', len(value)) + value)
+    elif isinstance(value, (list, tuple)):
+        output.append('l' + struct.pack('<I', len(value)))
+        for item in value:
+            encode_value(item, output)
+    elif isinstance(value, dict):
+        output.append('m' + struct.pack('<I', len(value)))
+        for key in sorted(value):
+            encode_value(key, output)
+            encode_value(value[key], output)
+    else:
+        raise TypeError("cannot store %s in image data" % type(value))
+
+
+def decode_value(data, offset):
+    """Decode the value at offset in data. Returns the value
+    and the offset after it"""
+    tag = data[offset:offset + 1]
+    offset += 1
+    if tag == 'n':
+        return None, offset
+    if tag == 'i':
+        return struct.unpack('<q', data[offset:offset + 8])[0], offset + 8
+    if tag == 'd':
+        return struct.unpack('<d', data[offset:offset + 8])[0], offset + 8
+    
+    if tag not in ('s', 'u', 'l', 'm'):
+        raise FormatError("unknown type %r" % tag)
+    count, = struct.unpack('<I', data[offset:offset + 4])
+    offset += 4
+    if tag in ('s', 'u'):
+        if offset + count > len(data):
+            raise FormatError("truncated string")
+        value = data[offset:offset + count]
+        if tag == 'u':
+            value = value.decode('utf-8')
+        return value, offset + count
+    if tag == 'l':
+        value = []
+        for index in xrange(count):
+            item, offset = decode_value(data, offset)
+            value.append(item)
+        return value, offset
+    value = {}
+    for index in xrange(count):
+        key, offset = decode_value(data, offset)
+        value[key], offset = decode_value(data, offset)
+    return value, offset
+
+
+def encode_data(data):
+    """The data file contents for the dict data"""
+    output = [header.pack(MAGIC, FORMAT_VERSION)]
+    encode_value(data, output)
+    return ''.join(output)
+
+
+def decode_data(contents):
+    """The dict stored in data file contents"""
+    if len(contents) < header.size:
+        raise FormatError("too short")
+    magic, version = header.unpack(contents[:header.size])
+    if magic != MAGIC:
+        raise FormatError("not an image data file")
+    if version > FORMAT_VERSION:
+        raise FormatError("saved by a newer version (format %d)" % version)
+    try:
+        data, offset = decode_value(contents, header.size)
+    except struct.error, error:
+        raise FormatError("truncated data (%s)" % error)
+    if not isinstance(data, dict) or offset != len(contents):
+        raise FormatError("damaged data")
+    return data
+
+
+def refuse_global(module, name):
+    """Stands in for looking up a class or function while unpickling"""
+    raise pickle.UnpicklingError("%s.%s is not allowed in image data"
+                                 % (module, name))
+
+
+def read_legacy(path):
+    """Data from a pickle saved by older versions. Only plain values
+    are loaded - anything that would need a class or function is
+    refused, so a crafted file cannot run code"""
+    unpickler = pickle.Unpickler(open(path, 'r')) # saved in text mode
+    if pickle.__name__ == 'cPickle':
+        unpickler.find_global = None
+    else:
+        # the python pickle module looks up all globals through find_class
+        unpickler.find_class = refuse_global
+    data = unpickler.load()
+    if not isinstance(data, dict):
+        raise FormatError("damaged data")
+    return data
+
+
+def read_data(filepath):
+    """The stored data for the image at filepath, or None if there is
+    none. Raises an exception if the data cannot be read"""
+    try:
+        contents = open(data_path(filepath), 'rb').read()
+    except IOError:
+        contents = None
+    if contents is not None:
+        return decode_data(contents)
+    
+    path = legacy_path(filepath)
+    if os.path.exists(path):
+        return read_legacy(path)
+    return None
+
+
+def write_data(datafile, data):
+    """Write data to datafile. It is written to a temporary file
+    first and renamed, so a failed write does not damage the old file"""
+    contents = encode_data(data)
+    handle, temppath = tempfile.mkstemp('.tmp', '.', os.path.dirname(datafile))
+    try:
+        output = os.fdopen(handle, 'wb')
+        try:
+            output.write(contents)
+        finally:
+            output.close()
+        replace_file(temppath, datafile)
+    except:
+        if os.path.exists(temppath):
+            os.remove(temppath)
+        raise
+    hide_file(datafile)
+
+
+class AnnotationWriter():
+    """Writes image data in a background thread. If the data for a
+    file is saved again before it has been written, only the latest
+    is written. onerror(datafile, error) is called from the writer
+    thread when a write fails"""
+    def __init__(self, onerror=None):
+        self.onerror = onerror
+        self.pending = {} # datafile: data
+        self.order = []   # datafiles in the order saved
+        self.writing = None
+        self.condition = threading.Condition()
+
+        worker = threading.Thread(target=self._work)
+        worker.setDaemon(True) # flush before exit to finish writes
+        worker.start()
+
+    def save(self, datafile, data):
+        """Queue data to be written to datafile"""
+        self.condition.acquire()
+        try:
+            if datafile not in self.pending:
+                self.order.append(datafile)
+            self.pending[datafile] = data
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def get(self, datafile):
+        """A copy of the data saved for datafile but not written yet,
+        or None. The queued data may be being written, so it is
+        never handed out to be changed"""
+        self.condition.acquire()
+        try:
+            if datafile in self.pending:
+                return dict(self.pending[datafile])
+            if self.writing and self.writing[0] == datafile:
+                return dict(self.writing[1])
+            return None
+        finally:
+            self.condition.release()
+
+    def flush(self):
+        """Wait until everything saved has been written"""
+        self.condition.acquire()
+        try:
+            while self.pending or self.writing:
+                self.condition.wait()
+        finally:
+            self.condition.release()
+
+    def _work(self):
+        """Writer loop - write pending data, oldest first"""
+        while True:
+            self.condition.acquire()
+            try:
+                while not self.pending:
+                    self.condition.wait()
+                datafile = self.order.pop(0)
+                self.writing = (datafile, self.pending.pop(datafile))
+            finally:
+                self.condition.release()
+
+            try:
+                try:
+                    write_data(*self.writing)
+                except Exception, error:
+                    if self.onerror:
+                        self.onerror(datafile, error)
+            finally:
+                self.condition.acquire()
+                self.writing = None
+                self.condition.notifyAll()
+                self.condition.release()
+
+
+def list_datafiles(dirname):
+    """Names of the data files in dirname"""
+    return set([os.path.basename(path) for path in
+                scan_images(dirname or os.curdir, ('.eep', '.pkl'))])
+
+
+class AnnotationIndex():
+    """The stored data for the images in a playlist, loaded in a
+    background thread. Each directory is listed once to find the
+    images that have data files, so no files are opened for images
+    without data. onloaded() is called from the loading thread
+    each time everything added so far has been loaded"""
+    def __init__(self, onloaded=None):
+        self.onloaded = onloaded
+        self.records = {} # image filepath: data, or None if no data
+        self.saved = {}   # data saved since starting, newer than the disk
+        self.pending = [] # image filepaths waiting to be loaded
+        self.listings = {} # dirname: names of the data files in it
+        self.generation = 0
+        self.condition = threading.Condition()
+
+        worker = threading.Thread(target=self._work)
+        worker.setDaemon(True) # do not hold up exit
+        worker.start()
+
+    def start(self, filepaths):
+        """Load the data for the images at filepaths, replacing the
+        data loaded for the previous playlist. Data saved since
+        starting is kept, the data file may not be written yet"""
+        self.condition.acquire()
+        try:
+            self.generation += 1
+            self.records = dict(self.saved)
+            self.pending = []
+            self.listings = {}
+        finally:
+            self.condition.release()
+        self.add(filepaths)
+
+    def add(self, filepaths):
+        """Load the data for more images in the playlist"""
+        self.condition.acquire()
+        try:
+            self.pending.extend([filepath for filepath in filepaths
+                                 if filepath not in self.records])
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def find(self, filepath):
+        """Returns (found, data). found is False if the data for
+        filepath has not been loaded (yet)"""
+        self.condition.acquire()
+        try:
+            if filepath in self.records:
+                return True, self.records[filepath]
+            return False, None
+        finally:
+            self.condition.release()
+
+    def update(self, filepath, data):
+        """Data for filepath has been saved"""
+        self.condition.acquire()
+        try:
+            self.records[filepath] = data
+            self.saved[filepath] = data
+        finally:
+            self.condition.release()
+
+    def forget(self, filepath):
+        """Drop the data for filepath, eg. when the image is renamed"""
+        self.condition.acquire()
+        try:
+            self.records.pop(filepath, None)
+            self.saved.pop(filepath, None)
+        finally:
+            self.condition.release()
+
+    def load(self, filepath, datafiles):
+        """Data for the image at filepath, or None if it has none"""
+        if (os.path.basename(data_path(filepath)) in datafiles or
+            os.path.basename(legacy_path(filepath)) in datafiles):
+            return read_data(filepath)
+        return None
+
+    def _work(self):
+        """Loader loop - load the pending images, a directory at a time"""
+        while True:
+            self.condition.acquire()
+            try:
+                while not self.pending:
+                    self.condition.wait()
+                filepaths, self.pending = self.pending, []
+                generation = self.generation
+                listings = self.listings
+            finally:
+                self.condition.release()
+
+            directories = {}
+            for filepath in filepaths:
+                directories.setdefault(os.path.dirname(filepath),
+                                       []).append(filepath)
+
+            for dirname, images in directories.items():
+                loaded = []
+                try:
+                    # listed once per playlist
+                    if dirname not in listings:
+                        listings[dirname] = list_datafiles(dirname)
+                    datafiles = listings[dirname]
+                except OSError:
+                    continue # not indexed, read when the image is shown
+                for filepath in images:
+                    try:
+                        loaded.append((filepath,
+                                       self.load(filepath, datafiles)))
+                    except Exception:
+                        pass # not indexed, read when the image is shown
+
+                self.condition.acquire()
+                try:
+                    if generation != self.generation:
+                        break # a new playlist has been started
+                    for filepath, data in loaded:
+                        # data saved since loading started is newer
+                        if filepath not in self.records:
+                            self.records[filepath] = data
+                finally:
+                    self.condition.release()
+
+            if self.onloaded and not self.pending:
+                self.onloaded()
@@ -38,18 +38,26 @@ class Config():
                    'caliper_measurement' : 'Time',
                    'doodle_width' : '1',
                    'doodle_color' : 'red',
-                   'show_fullscreen_dialog' : 'True'
+                   'doodle_tolerance' : '1', # world units, 0 keeps all points
+                   'show_fullscreen_dialog' : 'True',
+                   'prefetch_count' : '2', # images prefetched on either side
+                   'image_cache_mb' : '256', # memory for decoded images
+                   'bitmap_cache_mb' : '64', # memory for fitted bitmaps
+                   'disk_cache_mb' : '512' # disk for cached renditions
                    }
         
 
     def readOptions(self):
         try:
             self.parser.read(self.configfile)
-            for key in self.options:
-                self.options[key] = self.parser.get('options', key)
-
-        except: # if file is not present or is damaged
+        except: # if file is damaged
             return # donot change defaults
+
+        for key in self.options:
+            try:
+                self.options[key] = self.parser.get('options', key)
+            except: # file not present or option missing in older files
+                pass # keep default
             
 
     def writeOptions(self):
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+
+"""
+Listing the images in a directory.
+scandir (in os from python 3.5, or the scandir package) gets the file
+type along with the name, so that no stat is needed per file. This
+matters for directories with many files on network drives.
+"""
+
+import os
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError: # fall back to os.listdir
+        scandir = None
+
+image_extensions = set(['.bmp', '.png', '.jpg', '.jpeg', '.tif', '.tiff'])
+
+
+def scan_images(dirname, extensions=image_extensions):
+    """Yield the paths of the files in dirname with one of extensions,
+    as they are found"""
+    if scandir is None:
+        for name in os.listdir(dirname):
+            if os.path.splitext(name)[1].lower() in extensions:
+                yield os.path.join(dirname, name)
+        return
+
+    for entry in scandir(dirname):
+        # name is checked first, it does not need a system call
+        if os.path.splitext(entry.name)[1].lower() in extensions and \
+               entry.is_file():
+            yield os.path.join(dirname, entry.name)
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+
+"""
+Cache of downsampled renditions of images on disk.
+Decoding a large scan and resampling it for the screen takes much
+longer than reading a screen sized PNG, so renditions made once are
+kept in the user's cache directory and used again in later sessions.
+A rendition is found by the path, modification time and size of the
+original, so it is not used once the original changes.
+Renditions are encoded and written in a background thread, so that
+storing one does not hold up showing the image.
+"""
+
+from __future__ import division
+import os
+import sys
+import tempfile
+import threading
+
+try:
+    from hashlib import sha1
+except ImportError: # python < 2.5
+    from sha import new as sha1
+
+## Pillow fork changes imports, so check for those
+try:
+    from PIL import Image
+    from PIL import PngImagePlugin
+except ImportError:
+    import Image
+    import PngImagePlugin
+
+
+def cache_dir():
+    """Directory for eepee's cached files - under LOCALAPPDATA on
+    windows and XDG_CACHE_HOME (~/.cache) elsewhere"""
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or os.environ.get('APPDATA')
+        if base:
+            return os.path.join(base, 'eepee', 'cache')
+    base = os.environ.get('XDG_CACHE_HOME') or \
+           os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'eepee')
+
+
+class DiskCache():
+    """Renditions of images stored as PNG files in directory.
+    When the files take more than maxsize bytes, the least
+    recently used ones are removed. At most maxpending renditions
+    wait to be written, beyond that the oldest are dropped"""
+    def __init__(self, directory, maxsize, maxpending=16):
+        self.directory = directory
+        self.maxsize = maxsize
+        self.totalsize = None # found on first write
+        self.lock = threading.Lock()
+
+        self.maxpending = maxpending
+        self.pending = {} # key: (image, fullsize) not written yet
+        self.order = []   # keys waiting to be written, oldest first
+        self.condition = threading.Condition()
+
+        writer = threading.Thread(target=self._work)
+        writer.setDaemon(True) # renditions not written yet are made again
+        writer.start()
+
+    def key(self, filepath, variant):
+        """Name of the cache file for a rendition of filepath.
+        Returns None if filepath cannot be read"""
+        try:
+            stat = os.stat(filepath)
+        except OSError:
+            return None
+        ident = '%s\n%r\n%d\n%s' % (os.path.abspath(filepath), stat.st_mtime,
+                                    stat.st_size, variant)
+        if isinstance(ident, unicode):
+            ident = ident.encode('utf-8')
+        return sha1(ident).hexdigest() + '.png'
+
+    def get(self, filepath, variant):
+        """The stored rendition of filepath as (image, fullsize),
+        or None if there is none"""
+        key = self.key(filepath, variant)
+        if key is None:
+            return None
+
+        # may be waiting to be written
+        self.condition.acquire()
+        try:
+            if key in self.pending:
+                return self.pending[key]
+        finally:
+            self.condition.release()
+
+        path = os.path.join(self.directory, key)
+        try:
+            image = Image.open(path)
+            image.load()
+            fullsize = tuple([int(value) for value in
+                              image.info['fullsize'].split(',')])
+        except Exception: # not there, or damaged
+            return None
+
+        try:
+            os.utime(path, None) # recently used
+        except OSError:
+            pass
+        return image, fullsize
+
+    def put(self, filepath, variant, image, fullsize):
+        """Store a rendition of filepath. fullsize is the size
+        of the original image. It is written in the background"""
+        key = self.key(filepath, variant)
+        if key is None:
+            return
+
+        self.condition.acquire()
+        try:
+            if key not in self.order:
+                self.order.append(key)
+            self.pending[key] = (image, fullsize)
+            while len(self.order) > self.maxpending:
+                del self.pending[self.order.pop(0)]
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def _work(self):
+        """Writer loop - write pending renditions, oldest first"""
+        while True:
+            self.condition.acquire()
+            try:
+                while not self.order:
+                    self.condition.wait()
+                key = self.order.pop(0)
+                entry = self.pending[key]
+            finally:
+                self.condition.release()
+
+            self.write(key, *entry)
+
+            self.condition.acquire()
+            try:
+                # unless replaced while being written
+                if self.pending.get(key) is entry:
+                    del self.pending[key]
+            finally:
+                self.condition.release()
+
+    def write(self, key, image, fullsize):
+        """Write a rendition to the cache file key"""
+        if image.mode not in ('RGB', 'RGBA', 'L', 'P', '1'):
+            image = image.convert('RGB') # not possible in a PNG
+
+        info = PngImagePlugin.PngInfo()
+        info.add_text('fullsize', '%d,%d' % tuple(fullsize))
+
+        temppath = None
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            # write under another name and rename, so that a
+            # partly written file is never read
+            handle, temppath = tempfile.mkstemp('.tmp', '', self.directory)
+            os.close(handle)
+            image.save(temppath, 'PNG', pnginfo=info, compress_level=1)
+            path = os.path.join(self.directory, key)
+            if os.path.exists(path):
+                os.remove(path) # rename does not replace on windows
+            os.rename(temppath, path)
+            filesize = os.path.getsize(path)
+        except Exception:
+            # cache is only an optimization
+            if temppath and os.path.exists(temppath):
+                try:
+                    os.remove(temppath)
+                except OSError:
+                    pass
+            return
+
+        self.lock.acquire()
+        try:
+            if self.totalsize is None:
+                self.totalsize = sum([entry[2] for entry in self.entries()])
+            else:
+                self.totalsize += filesize
+            if self.totalsize > self.maxsize:
+                self.evict()
+        finally:
+            self.lock.release()
+
+    def entries(self):
+        """(path, last use, size) of every file in the cache"""
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+
+        entries = []
+        for name in names:
+            if not name.endswith('.png'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((path, stat.st_mtime, stat.st_size))
+        return entries
+
+    def evict(self):
+        """Remove the least recently used files until the cache
+        is down to three quarters of maxsize"""
+        entries = self.entries()
+        entries.sort(key=lambda entry: entry[1])
+        self.totalsize = sum([entry[2] for entry in entries])
+        for path, mtime, size in entries:
+            if self.totalsize <= self.maxsize * 3 // 4:
+                break
+            try:
+                os.remove(path)
+                self.totalsize -= size
+            except OSError:
+                pass
+
+    def clear(self):
+        """Remove all files from the cache"""
+        self.condition.acquire()
+        try:
+            self.pending = {}
+            self.order = []
+        finally:
+            self.condition.release()
+
+        self.lock.acquire()
+        try:
+            for path, mtime, size in self.entries():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self.totalsize = 0
+        finally:
+            self.lock.release()
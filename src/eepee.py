@@ -1,14 +1,12 @@
 #!/usr/bin/env python
 
 from __future__ import division
-import sys, os, copy
+import sys, os, copy, math
+import threading, time
 import shutil
 import glob
-
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
+from itertools import izip
+from bisect import bisect_left, bisect_right
 
 import wx
 from wx.lib.mixins.listctrl import ListCtrlAutoWidthMixin
@@ -20,6 +18,18 @@ from playlist_select import PlayListSelector
 from config_manager import PreferenceDialog, Config
 from ppt_export import Converter_MS, Converter_OO, ConverterError
 from fullscreen_help_dialog import help_dialog
+from image_cache import LRUCache, Prefetcher, Resampler, CachedImage
+from image_cache import load_image, scale_frame, image_data, reduce_image
+from image_cache import load_region, draft_size
+from mapped_image import open_mapped, MappedView
+from thumbnails import ThumbnailMaker
+from dirscan import scan_images
+from annotation_store import AnnotationWriter, AnnotationIndex
+from annotation_store import pack_calipers, unpack_calipers
+from annotation_store import data_path, legacy_path, read_data, FormatError
+from disk_cache import DiskCache, cache_dir
+from strokes import StrokeList, StrokeSimplifier, simplify
+from tile_pyramid import TilePyramid, TileMaker
 
 ## Import Image plugins separately and then convince Image that is
 ## fully initialized - needed when compiling for windows, otherwise
@@ -70,6 +80,9 @@ ID_NEWPL       = wx.NewId()    ;   ID_EDITPL     = wx.NewId()
 ID_KEYS        = wx.NewId()    ;   ID_PREF       = wx.NewId()
 ID_CALIPERREMOVE = wx.NewId()  ;   # ID_IMPORT     = wx.NewId()
 ID_FULLSCREEN = wx.NewId()
+ID_ZOOMIN      = wx.NewId()    ;   ID_ZOOMOUT    = wx.NewId()
+ID_ZOOMFIT     = wx.NewId()    ;   ID_CLEARCACHE = wx.NewId()
+ID_CACHESTATS  = wx.NewId()
 
 
 shortcuts = """
@@ -84,11 +97,16 @@ Ctrl-b  - Calibrate\n
 Ctrl-c  - Start caliper\n
 Ctrl-d  - Start/stop doodle\n
 Ctrl-x  - Clear doodle\n
+Ctrl-=  - Zoom in\n
+Ctrl--  - Zoom out\n
+Ctrl-0  - Fit image to window\n
 PgDn    - Next image\n
 PgDn    - Prev image\n
 Ctrl-q  - Quit\n\n
 Left click - Start new caliper\n
 Right click - Removes caliper\n
+Ctrl + mouse wheel - Zoom in or out\n
+Middle button drag - Move zoomed image\n
 """
 
 #last png is for default save ext
@@ -121,16 +139,51 @@ class MyFrame(wx.Frame):
         # 2. A notebook panel holding the playlist and notes
         self.canvas = Canvas(self.splitter)
         self.displayimage = DisplayImage(self)
+
+        # image data is written in the background
+        self.annotationwriter = AnnotationWriter(
+            lambda datafile, error: wx.CallAfter(self.OnSaveError, datafile))
+        
+        # the data for the whole playlist is loaded in the background
+        self.annotationindex = AnnotationIndex(
+            lambda: wx.CallAfter(self.OnAnnotationsLoaded))
+        
+        # screen sized versions of images are kept on disk
+        # between sessions
+        self.diskcache = DiskCache(cache_dir(), self.canvas.disk_cache_size)
+        
+        # decoded images are cached, and the images next to the one
+        # being shown are loaded in the background
+        self.imagecache = LRUCache(self.canvas.image_cache_size,
+                                   lambda entry: entry.cost())
+        self.prefetcher = Prefetcher(self.imagecache,
+                                     self.displayimage.PrepareImage)
         
         self.notebookpanel = wx.Panel(self.splitter, -1)
         self.nb = wx.Notebook(self.notebookpanel)
         self.notepadpanel = wx.Panel(self.nb, -1)
                 
-        self.listbox = AutoWidthListCtrl(self.nb)
+        self.listbox = AutoWidthListCtrl(self.nb, self.annotationindex)
+        
+        # thumbnails of the playlist, filled in as they are made
+        # in the background
+        self.thumbnail_size = 96
+        self.thumbnaillist = wx.ListCtrl(self.nb, -1, style=wx.LC_ICON|
+                                         wx.LC_AUTOARRANGE|wx.LC_SINGLE_SEL)
+        self.thumbnailimages = wx.ImageList(self.thumbnail_size,
+                                            self.thumbnail_size)
+        self.thumbnaillist.SetImageList(self.thumbnailimages,
+                                        wx.IMAGE_LIST_NORMAL)
+        self.thumbnailmaker = ThumbnailMaker(
+            lambda *result: wx.CallAfter(self.OnThumbnail, *result),
+            self.thumbnail_size, self.diskcache)
+        self.thumbnailgeneration = None
+        self.thumbnailpaths = [] # path of each thumbnail item
 
         self.notepad = wx.TextCtrl(self.notepadpanel, -1,style=wx.TE_MULTILINE)
         
         self.nb.AddPage(self.listbox, "Playlist")
+        self.nb.AddPage(self.thumbnaillist, "Thumbnails")
         self.nb.AddPage(self.notepadpanel, "Notes")
 
         # unsplit splitter for now, split later when size can be calculated
@@ -176,11 +229,17 @@ class MyFrame(wx.Frame):
         self.Bind(wx.EVT_MENU, self.canvas.RemoveAllCalipers, id=ID_CALIPERREMOVE)
         # self.Bind(wx.EVT_MENU, self.ImportPresentation, id=ID_IMPORT)
         self.Bind(wx.EVT_MENU, self.ToggleFullScreen, id=ID_FULLSCREEN)
+        self.Bind(wx.EVT_MENU, self.canvas.ZoomIn, id=ID_ZOOMIN)
+        self.Bind(wx.EVT_MENU, self.canvas.ZoomOut, id=ID_ZOOMOUT)
+        self.Bind(wx.EVT_MENU, self.canvas.ZoomFit, id=ID_ZOOMFIT)
+        self.Bind(wx.EVT_MENU, self.ClearCache, id=ID_CLEARCACHE)
+        self.Bind(wx.EVT_MENU, self.ShowCacheStats, id=ID_CACHESTATS)
         self.Bind(wx.EVT_CLOSE, self.OnQuit)
 
         #self.listbox.Bind(wx.EVT_LEFT_DCLICK, self.JumptoImage)
         #self.listbox.Bind(wx.EVT_LIST_BEGIN_LABEL_EDIT, self.OnBeginEdit)
         self.listbox.Bind(wx.EVT_LIST_ITEM_ACTIVATED, self.JumptoImage)
+        self.thumbnaillist.Bind(wx.EVT_LIST_ITEM_ACTIVATED, self.JumptoImage)
         self.listbox.Bind(wx.EVT_LIST_END_LABEL_EDIT, self.OnEndEdit)
 
         self.last_dir = '' # last dir used for file open
@@ -208,11 +267,18 @@ class MyFrame(wx.Frame):
         edit_menu.Append(ID_DOODLE, "&Doodle\tCtrl-D", "Doodle on the canvas")
         edit_menu.Append(ID_CLEAR, "Clear\tCtrl-X", "Clear the doodle")
         edit_menu.Append(ID_PREF, "Preferences", "Edit preferences")
+        edit_menu.Append(ID_CLEARCACHE, "Clear Cache",
+                         "Remove cached images from disk")
         
         image_menu = wx.Menu()
         image_menu.Append(ID_ROTATELEFT, "Rotate &Left\tCtrl-L", "Rotate image left")
         image_menu.Append(ID_ROTATERIGHT, "Rotate &Right\tCtrl-R", "Rotate image right")
         image_menu.Append(ID_CROP, "Crop", "Crop the image")
+        image_menu.AppendSeparator()
+        image_menu.Append(ID_ZOOMIN, "Zoom &In\tCtrl-=", "Zoom in")
+        image_menu.Append(ID_ZOOMOUT, "Zoom &Out\tCtrl--", "Zoom out")
+        image_menu.Append(ID_ZOOMFIT, "&Fit to Window\tCtrl-0",
+                          "Show the whole image")
         
         playlist_menu = wx.Menu()
         playlist_menu.Append(ID_PREVIOUS, "Previous\tPGUP", "Previous image")
@@ -223,6 +289,8 @@ class MyFrame(wx.Frame):
         help_menu = wx.Menu()
         help_menu.Append(ID_ABOUT, "About", "About this application")
         help_menu.Append(ID_KEYS, 'List keyboard shortcuts', 'Shortcuts')
+        help_menu.Append(ID_CACHESTATS, 'Cache statistics',
+                         'Hits and misses of the image caches')
 
         # popopu menu to appear with right click
         self.popup_menu = wx.Menu()
@@ -305,6 +373,31 @@ class MyFrame(wx.Frame):
         
         self.canvas.config.readOptions()
         self.canvas.setOptions()
+        self.imagecache.maxsize = self.canvas.image_cache_size
+        self.canvas.bitmapcache.maxsize = self.canvas.bitmap_cache_size
+        self.diskcache.maxsize = self.canvas.disk_cache_size
+    
+    def ClearCache(self, event):
+        """Remove the image renditions cached on disk"""
+        self.diskcache.clear()
+        self.DisplayMessage("Image cache cleared")
+        
+    def ShowCacheStats(self, event):
+        """Show the hits and misses of the in memory caches"""
+        caches = [('Decoded images', self.imagecache),
+                  ('Bitmaps', self.canvas.bitmapcache)]
+        if self.canvas.pyramid:
+            caches.append(('Zoom tiles', self.canvas.pyramid.cache))
+        
+        lines = []
+        for name, cache in caches:
+            hits, misses, entries, cost = cache.stats()
+            lines.append("%s: %d hits, %d misses, %d entries, %.1f MB" % (
+                name, hits, misses, entries, cost / (1024 * 1024)))
+        dlg = wx.MessageDialog(self, '\n'.join(lines), 'Cache statistics',
+                               wx.OK)
+        dlg.ShowModal()
+        dlg.Destroy()
         
     def ListKeys(self, event):
         """List the keyboard shortcuts"""
@@ -397,9 +490,12 @@ class MyFrame(wx.Frame):
     def load_new_file(self, filepath):
         """Load a new file, given the path to the file"""
         self.InitializeSplitter()
-        self.playlist = PlayList(filepath)
+        # rest of the directory is added to the playlist as it is scanned
+        self.playlist = PlayList(filepath, lambda *scan:
+                                 wx.CallAfter(self.OnPlaylistScan, *scan))
         self.DisplayPlaylist()
         self.displayimage.LoadAndDisplayImage(filepath)
+        self.PrefetchNeighbours()
 
 
     def import_presentation(self, path_to_presentation):
@@ -440,6 +536,7 @@ class MyFrame(wx.Frame):
         
         # load file
         self.displayimage.LoadAndDisplayImage(firstfile)
+        self.PrefetchNeighbours()
 
     def OnEndEdit(self, event):
         """User has edited a filename in the playlist window"""
@@ -451,11 +548,41 @@ class MyFrame(wx.Frame):
             pass
         elif os.path.exists(newname):
             self.DisplayMessage("Filename already exists!")
-            self.listbox.SetStringItem(index, 0, os.path.basename(oldname)) # TODO
+            event.Veto() # keep the old name
         else:
-            st = shutil.move(oldname, newname)
-            print st # TODO:
-            self.DisplayMessage("Filename changed")
+            shutil.move(oldname, newname)
+            moveddata = self.RenameData(oldname, newname)
+            self.playlist.Rename(index, newname)
+            
+            # nothing is kept under the old name
+            self.imagecache.remove(oldname)
+            self.annotationindex.forget(oldname)
+            if getattr(self.displayimage, 'filepath', None) == oldname:
+                self.displayimage.filepath = newname
+                self.displayimage.datafile = \
+                    self.displayimage.GetDataFilePath(newname)
+            
+            self.listbox.SetPaths(self.playlist.playlist)
+            self.DisplayThumbnails()
+            self.SelectInPlaylist()
+            if moveddata:
+                self.DisplayMessage("Filename changed")
+            else:
+                self.DisplayMessage("Filename changed, but the image data"
+                                    " could not be moved")
+    
+    def RenameData(self, oldname, newname):
+        """Move the data files of an image that has been renamed.
+        Returns False if they could not be moved"""
+        self.annotationwriter.flush() # nothing left to write to the old file
+        try:
+            for path in (data_path, legacy_path):
+                if os.path.exists(path(oldname)) and \
+                       not os.path.exists(path(newname)):
+                    shutil.move(path(oldname), path(newname))
+        except (IOError, OSError):
+            return False
+        return True
         
     def NewPlaylist(self, event):
         """Construct a new playlist"""
@@ -469,43 +596,134 @@ class MyFrame(wx.Frame):
     
     def DisplayPlaylist(self):
         """Display a new playlist in the listbox"""
-        #print dir(self.listbox)
-        self.listbox.ClearAll()
-        self.listbox.InsertColumn(0, 'Filename')
-        for filename in self.playlist.playlist:
-            index = self.listbox.InsertStringItem(sys.maxint,
-                                                  os.path.split(filename)[1])
-        self.listbox.SetItemState(self.playlist.nowshowing,
-                                  wx.LIST_STATE_SELECTED, wx.LIST_STATE_SELECTED)
+        self.listbox.SetPaths(self.playlist.playlist)
+        self.DisplayThumbnails()
+        self.annotationindex.start(self.playlist.playlist)
+        self.SelectInPlaylist()
+    
+    def OnPlaylistScan(self, playlist, paths, done):
+        """More files have been found for the playlist"""
+        if playlist is not self.playlist:
+            return # playlist has been replaced since
+        playlist.AddFiles(paths)
+        self.listbox.SetPaths(playlist.playlist)
+        self.annotationindex.add(paths)
+        if done:
+            self.DisplayThumbnails()
+            self.PrefetchNeighbours()
+        self.SelectInPlaylist()
+    
+    def OnAnnotationsLoaded(self):
+        """The data for the playlist has been loaded, show the badges"""
+        self.listbox.Refresh()
+    
+    def DisplayThumbnails(self):
+        """Show the playlist as thumbnails. All items start with a
+        blank image, which is replaced as each thumbnail is made.
+        While a directory is scanned the playlist grows, so the items
+        are kept as the paths they were made for"""
+        self.thumbnaillist.DeleteAllItems()
+        self.thumbnailimages.RemoveAll()
+        blank = wx.EmptyBitmap(self.thumbnail_size, self.thumbnail_size)
+        memdc = wx.MemoryDC()
+        memdc.SelectObject(blank)
+        memdc.SetBackground(wx.WHITE_BRUSH)
+        memdc.Clear()
+        memdc.SelectObject(wx.NullBitmap)
+        self.thumbnailimages.Add(blank)
+        
+        self.thumbnailpaths = list(self.playlist.playlist)
+        for filename in self.thumbnailpaths:
+            self.thumbnaillist.InsertImageStringItem(sys.maxint,
+                                    os.path.split(filename)[1], 0)
+        self.thumbnailgeneration = self.thumbnailmaker.start(
+            self.thumbnailpaths, self.playlist.nowshowing)
+    
+    def OnThumbnail(self, generation, position, thumbnail):
+        """A thumbnail is ready - show it if it is for the
+        playlist being shown"""
+        if generation != self.thumbnailgeneration or thumbnail is None:
+            return
+        index = self.thumbnailimages.Add(self.canvas.ImageToBitmap(thumbnail))
+        self.thumbnaillist.SetItemImage(position, index)
+    
+    def SelectInPlaylist(self):
+        """Select the image being shown in the playlist views"""
+        if not self.playlist.playlist:
+            return
+        position = self.playlist.nowshowing
+        for listctrl, index in ((self.listbox, position),
+                                (self.thumbnaillist,
+                                 self.ThumbnailIndex(position))):
+            if index == -1:
+                continue
+            listctrl.SetItemState(index, wx.LIST_STATE_SELECTED,
+                                  wx.LIST_STATE_SELECTED)
+            listctrl.EnsureVisible(index)
+    
+    def ThumbnailIndex(self, position):
+        """The thumbnail item for the image at position in the
+        playlist, or -1 if it has none"""
+        filepath = self.playlist.playlist[position]
+        if self.thumbnailpaths[position:position + 1] == [filepath]:
+            return position # thumbnails are in step with the playlist
+        if filepath in self.thumbnailpaths: # short while scanning
+            return self.thumbnailpaths.index(filepath)
+        return -1
     
     def SelectNextImage(self,event):
         self.CleanUp()
         self.playlist.nowshowing += 1
         if self.playlist.nowshowing == len(self.playlist.playlist):
             self.playlist.nowshowing = 0
-        self.listbox.SetItemState(self.playlist.nowshowing,
-                                  wx.LIST_STATE_SELECTED, wx.LIST_STATE_SELECTED)
+        self.SelectInPlaylist()
 
         self.displayimage.LoadAndDisplayImage(self.playlist.playlist[
                                                 self.playlist.nowshowing])
+        self.PrefetchNeighbours()
         
     def SelectPrevImage(self,event):
         self.CleanUp()
         self.playlist.nowshowing -= 1
         if self.playlist.nowshowing == -1:
             self.playlist.nowshowing = len(self.playlist.playlist)-1
-        self.listbox.SetItemState(self.playlist.nowshowing,
-                                  wx.LIST_STATE_SELECTED, wx.LIST_STATE_SELECTED)
+        self.SelectInPlaylist()
 
         self.displayimage.LoadAndDisplayImage(self.playlist.playlist[
                                                 self.playlist.nowshowing])
+        self.PrefetchNeighbours()
        
     def JumptoImage(self,event):
-        """On double clicking in listbox select that image"""
+        """On double clicking in listbox or thumbnails select that image"""
         self.CleanUp()
-        self.playlist.nowshowing = self.listbox.GetNextSelected(-1)
+        if event.GetEventObject() is self.thumbnaillist:
+            self.playlist.nowshowing = self.playlist.Find(
+                self.thumbnailpaths[event.GetIndex()])
+        else:
+            self.playlist.nowshowing = event.GetIndex()
+        self.SelectInPlaylist()
         self.displayimage.LoadAndDisplayImage(self.playlist.playlist[
                                             self.playlist.nowshowing])
+        self.PrefetchNeighbours()
+
+    def PrefetchNeighbours(self):
+        """Start loading the images on either side of the current one
+        in the background, nearest first and going forward before back"""
+        playlist = self.playlist.playlist
+        if not playlist:
+            return
+        
+        neighbours = []
+        for step in range(1, self.canvas.prefetch_count + 1):
+            for position in (self.playlist.nowshowing + step,
+                             self.playlist.nowshowing - step):
+                filepath = playlist[position % len(playlist)]
+                if filepath not in neighbours:
+                    neighbours.append(filepath)
+        
+        nowshowing = playlist[self.playlist.nowshowing]
+        self.prefetcher.prefetch([filepath for filepath in neighbours
+                                  if filepath != nowshowing])
     
     def CleanUp(self):
         """Clean up on closing an image"""
@@ -518,17 +736,57 @@ class MyFrame(wx.Frame):
         self.SetStatusText(message, 0) #TODO: mechanism for alerting user
         
     
+    def OnSaveError(self, datafile):
+        """Image data could not be written"""
+        imagename = os.path.basename(datafile)[1:-4] # strip '.' and '.eep'
+        self.DisplayMessage("Could not save image data for %s" % (imagename))
+    
     def OnQuit(self, event):
         """On quitting the application"""
         self.CleanUp()
+        self.annotationwriter.flush() # finish saving
         sys.exit(0)
 
 #------------------------------------------------------------------------------    
 class AutoWidthListCtrl(wx.ListCtrl, ListCtrlAutoWidthMixin):
-    def __init__(self, parent, *args, **kwargs):
+    """List of file names in a playlist, with badges for the images
+    that are calibrated, cropped or have notes. It is a virtual list -
+    names and badges are made only for the rows being shown"""
+    def __init__(self, parent, annotations, *args, **kwargs):
         wx.ListCtrl.__init__(self, parent, -1,
-                             style=wx.LC_REPORT|wx.LC_EDIT_LABELS|wx.LC_SINGLE_SEL)
+                             style=wx.LC_REPORT|wx.LC_EDIT_LABELS|
+                             wx.LC_SINGLE_SEL|wx.LC_VIRTUAL)
         ListCtrlAutoWidthMixin.__init__(self)
+        self.InsertColumn(0, 'Filename')
+        self.InsertColumn(1, 'Marks', width=100)
+        self.setResizeColumn(1) # filename takes up the rest
+        self.annotations = annotations # AnnotationIndex for the badges
+        self.paths = []
+    
+    def SetPaths(self, paths):
+        """Show the file names of paths"""
+        self.paths = paths
+        self.SetItemCount(len(paths))
+        self.Refresh()
+    
+    def OnGetItemText(self, item, column):
+        if column == 1:
+            found, data = self.annotations.find(self.paths[item])
+            return self.Badges(data)
+        return os.path.basename(self.paths[item])
+    
+    def Badges(self, data):
+        """Text marking what is saved in the image data"""
+        if not data:
+            return ''
+        badges = []
+        if data.get("calibration"):
+            badges.append("Cal")
+        if list(data.get("cropframe", [0,0,0,0])) != [0,0,0,0]:
+            badges.append("Crop")
+        if data.get("note", '').strip():
+            badges.append("Note")
+        return ' '.join(badges)
 
         
 #------------------------------------------------------------------------------    
@@ -546,9 +804,29 @@ class Canvas(wx.Window):
         self.rubberband = RubberBand(self)
         self.doodle = Doodle(self)
             
-        # Image height will always be 1000 units unless zoomed in
+        # Image height will always be 1000 units. Zooming in only
+        # changes how many pixels that is
         self.maxheight = 1000
         
+        # zoom is relative to fitting the image to the canvas. When
+        # zoomed in, center is the point of the image (world coords)
+        # at the center of the canvas
+        self.zoom = 1
+        self.maxzoom = 16
+        self.zoomstep = 2 ** 0.5
+        self.center = (0, 0)
+        self.viewkey = None # zoom is reset when the image changes
+        self.panfrom = None # last mouse position while panning
+        
+        # zoomed in images are drawn from tiles, made only for the
+        # part that is visible
+        # Tiles that need more detail than the decoded image are made in
+        # the background, with the decoded image drawn in their place
+        self.pyramid = None
+        self.tile_cache_size = 64 * 1024 * 1024
+        self.tilemaker = TileMaker(self.OnTileMade)
+        self._tilesmade = False
+        
         # calibration  =   milliseconds / world_units
         self.calibration = 0  #0 means uncalibrated
         
@@ -558,15 +836,54 @@ class Canvas(wx.Window):
         # caliper list is a list of all calipers
         self.caliperlist = []
         self.activecaliperindex = -1 #only one caliper is active
+        self.caliperindex = CaliperIndex() # for finding calipers to hit
+        self.hitcaliper = None # caliper marked as hittable
         self.cursors = [wx.CURSOR_ARROW, wx.CURSOR_SIZEWE,
                         wx.CURSOR_HAND]        
         # flag to check if image is loaded
-        self.resizedimage = None
+        self.bmp = None
+        
+        # static layer - the background image with the calipers and
+        # doodle lines that are not being changed. Moving things are
+        # drawn over it
+        self.staticbmp = None
+        
+        # fitted bitmaps are cached so that going back to an image or
+        # to a previous canvas size does not need another resample
+        self.bitmapcache = LRUCache(self.bitmap_cache_size,
+                            lambda bmp: bmp.GetWidth() * bmp.GetHeight() * 4)
+        
+        # large images are shown first with a quick preview, the
+        # antialiased resize is done in the background and swapped in
+        # when ready
+        self.progressive_pixels = 4000000 # source size to go progressive
+        self.resampler = Resampler(self.OnResampled)
+        self.bgkey = None # key of the bitmap being shown
+        self._resampled = None # (key, resized image) from the resampler
         
         self._BGchanged = False
         self._FGchanged = False
         
+        # latest mouse motion, waiting to be handled at next idle
+        self._pendingmotion = None
+        self._pendingpan = None # latest position while panning
+        
+        # parts of the canvas (rects in pixels) to be redrawn when only
+        # some of the foreground has changed, eg. a caliper moving
+        self._damaged = []
+        
+        # space taken by caliper measurement text
+        self.textextent = self.GetTextExtent('00000 units')
+        
+        # back buffer is only reallocated when the canvas outgrows it
+        self.bufferwidth, self.bufferheight = 0, 0
+        
+        # during a window drag, redraw only once the size settles
+        self.resize_delay = 100 # ms
+        self.resizetimer = wx.Timer(self)
+        
         self.Bind(wx.EVT_SIZE, self.OnResize)
+        self.Bind(wx.EVT_TIMER, self.OnResizeDone, self.resizetimer)
         self.Bind(wx.EVT_IDLE, self.OnIdle)
         self.Bind(wx.EVT_MOUSE_EVENTS, self.OnMouseEvents)
 
@@ -597,6 +914,15 @@ class Canvas(wx.Window):
         self.active_caliper_color = self.config.options.get('active_caliper_color')
         self.doodle_width = int(self.config.options.get('doodle_width'))
         self.doodle_color = self.config.options.get('doodle_color')
+        self.doodle_tolerance = float(self.config.options.get(
+                'doodle_tolerance'))
+        self.prefetch_count = int(self.config.options.get('prefetch_count'))
+        self.image_cache_size = int(self.config.options.get(
+                'image_cache_mb')) * 1024 * 1024
+        self.bitmap_cache_size = int(self.config.options.get(
+                'bitmap_cache_mb')) * 1024 * 1024
+        self.disk_cache_size = int(self.config.options.get(
+                'disk_cache_mb')) * 1024 * 1024
 
         self.show_fullscreen_dialog = self.config.options.get(
             'show_fullscreen_dialog', 'True') == 'True'
@@ -620,7 +946,7 @@ class Canvas(wx.Window):
 
     def handleMouseEvents(self, event):
         """handle mouse events when no tool is active"""
-        if self.resizedimage:
+        if self.bmp:
             pos = event.GetPosition()
             worldx, worldy = (self.PixelsToWorld(pos.x, 'xaxis'),
                               self.PixelsToWorld(pos.y, 'yaxis'))
@@ -628,6 +954,7 @@ class Canvas(wx.Window):
             if event.Moving():
                 # check for hitobject and mark them
                 caliper, caliperindex, hit_type = self.HitObject(worldx, worldy)
+                self.MarkHitObject(caliper, hit_type)
                     
             elif event.LeftDown():
                 # check for hit object and activate it
@@ -635,9 +962,11 @@ class Canvas(wx.Window):
                 if caliper:
                     self.activetool = 'caliper'
                     self.activecaliperindex = caliperindex
+                    self._FGchanged = True # now live, not static
                     if hit_type == 1:
                         #flip the caliper legs, then just move second leg
                         caliper.x1, caliper.x2 = caliper.x2, caliper.x1
+                        self.caliperindex.invalidate()
                         caliper.state = 2
                         self.SetCursor(wx.StockCursor(self.cursors[1]))
                     elif hit_type == 2: #move second leg
@@ -669,22 +998,45 @@ class Canvas(wx.Window):
         
     def OnResize(self, event):
         """canvas resize triggers bgchanged flag so that it will
-        be redrawn on next idle event"""
+        be redrawn once the size stops changing"""
         # update / initialize height and width
         self.width, self.height = self.GetSize()
         
-        # update / create the buffer for the buffered dc
-        image = wx.EmptyImage(self.width, self.height)
-        wx.Image.Create(image,self.width, self.height, False)
-        wx.Image.SetRGBRect(image, wx.Rect(0, 0, self.width, self.height),
-                            255, 255, 255)        
-        self.buffer = wx.BitmapFromImage(image)
-        
-        if self.resizedimage: # only if image is loaded
-            self._BGchanged = True
+        # update / create the buffer for the buffered dc. A buffer
+        # larger than the canvas is fine, so only grow it - and
+        # at least to screen size so that it rarely needs to grow
+        if self.width > self.bufferwidth or self.height > self.bufferheight:
+            screenwidth, screenheight = wx.GetDisplaySize()
+            self.bufferwidth = max(self.width, self.bufferwidth, screenwidth)
+            self.bufferheight = max(self.height, self.bufferheight,
+                                    screenheight)
+            self.buffer = wx.EmptyBitmap(self.bufferwidth, self.bufferheight)
+            
+            memdc = wx.MemoryDC()
+            memdc.SelectObject(self.buffer)
+            memdc.SetBackground(wx.WHITE_BRUSH)
+            memdc.Clear()
+            memdc.SelectObject(wx.NullBitmap)
+        
+        if self.bmp: # only if image is loaded
+            # (re)start the timer - fires when resizing pauses
+            self.resizetimer.Start(self.resize_delay, wx.TIMER_ONE_SHOT)
+    
+    def OnResizeDone(self, event):
+        """Size has settled - redraw on next idle event"""
+        self._BGchanged = True
         
     def OnIdle(self, event):
         """Redraw if there is a change"""
+        self.HandlePendingMotion()
+        self.HandlePendingPan()
+        
+        if self._resampled:
+            self.SwapResampled()
+
+        if self._tilesmade:
+            self._tilesmade = False
+            self._BGchanged = True
 
         if self._BGchanged or self._FGchanged:
             dc = wx.BufferedDC(wx.ClientDC(self), self.buffer,
@@ -697,12 +1049,46 @@ class Canvas(wx.Window):
            
         elif self._FGchanged:
             self.Draw(dc)
+        
+        elif self._damaged:
+            self.DrawDamaged()
 
     def OnPaint(self, event):
         dc = wx.BufferedPaintDC(self, self.buffer)
 
         
     def OnMouseEvents(self, event):
+        """Handle mouse events. Plain mouse motion is coalesced -
+        only the latest position is handled, on the next idle event.
+        Doodles need every point, so they get all motion events.
+        Zooming and panning work with any tool"""
+        if event.GetEventType() == wx.wxEVT_MOUSEWHEEL:
+            if event.ControlDown():
+                self.OnZoomWheel(event)
+            return
+        
+        if event.MiddleDown() or event.MiddleUp() or \
+               (self.panfrom and event.Dragging() and event.MiddleIsDown()):
+            self.OnPan(event)
+            return
+        
+        if event.GetEventType() == wx.wxEVT_MOTION and \
+               self.activetool != "doodle":
+            self._pendingmotion = MotionEvent(event)
+            return
+        
+        # handle motion before this event to keep the order
+        self.HandlePendingMotion()
+        self.DispatchMouseEvent(event)
+    
+    def HandlePendingMotion(self):
+        """Handle the latest coalesced motion event, if any"""
+        if self._pendingmotion:
+            event = self._pendingmotion
+            self._pendingmotion = None
+            self.DispatchMouseEvent(event)
+    
+    def DispatchMouseEvent(self, event):
         """Handle mouse events depending on active tool"""
         
         if self.activetool == None: 
@@ -740,6 +1126,81 @@ class Canvas(wx.Window):
             self.doodle.handleMouseEvents(event)
         
 
+    def OnZoomWheel(self, event):
+        """Zoom in or out, keeping the point under the mouse in place"""
+        if event.GetWheelRotation() > 0:
+            zoom = self.zoom * self.zoomstep
+        else:
+            zoom = self.zoom / self.zoomstep
+        pos = event.GetPosition()
+        self.ZoomAt(zoom, pos.x, pos.y)
+    
+    def OnPan(self, event):
+        """Drag the zoomed image with the middle button. As with other
+        motion, dragging is coalesced - the image is moved to the
+        latest position on the next idle event"""
+        pos = event.GetPosition()
+        if event.MiddleDown():
+            self.panfrom = pos
+        elif event.MiddleUp():
+            self._pendingpan = pos
+            self.HandlePendingPan()
+            self.panfrom = None
+        else:
+            self._pendingpan = pos
+    
+    def HandlePendingPan(self):
+        """Move the zoomed image to the latest panning position, if any"""
+        if self._pendingpan is None or self.panfrom is None:
+            return
+        pos = self._pendingpan
+        self._pendingpan = None
+        if self.zoom > 1:
+            centerx, centery = self.center
+            self.SetCenter(centerx - (pos.x - self.panfrom.x) * self.factor,
+                           centery - (pos.y - self.panfrom.y) * self.factor)
+            self._BGchanged = True
+        self.panfrom = pos
+    
+    def ZoomIn(self, event):
+        """Zoom in on the center of the canvas"""
+        self.ZoomAt(self.zoom * self.zoomstep, self.width / 2, self.height / 2)
+    
+    def ZoomOut(self, event):
+        """Zoom out from the center of the canvas"""
+        self.ZoomAt(self.zoom / self.zoomstep, self.width / 2, self.height / 2)
+    
+    def ZoomFit(self, event):
+        """Fit the whole image to the canvas again"""
+        self.ZoomAt(1, self.width / 2, self.height / 2)
+        
+    def ZoomAt(self, zoom, x, y):
+        """Change zoom so that the point of the image at pixel x, y
+        stays where it is"""
+        if not self.bmp:
+            return
+        zoom = max(1, min(zoom, self.maxzoom))
+        if zoom == self.zoom:
+            return
+        
+        # world point under x, y and world units per pixel after zooming
+        worldx = (x - self.xoffset) * self.factor
+        worldy = (y - self.yoffset) * self.factor
+        factor = self.factor * self.zoom / zoom
+        
+        self.zoom = zoom
+        self.SetCenter(worldx - (x - self.width / 2) * factor,
+                       worldy - (y - self.height / 2) * factor)
+        self._BGchanged = True
+    
+    def SetCenter(self, worldx, worldy):
+        """Set the point at the center of the canvas when zoomed,
+        limited so that the image does not leave the canvas"""
+        imagewidth, imageheight = self.frame.displayimage.image.size
+        worldwidth = self.maxheight * imagewidth / imageheight
+        self.center = (max(0, min(worldx, worldwidth)),
+                       max(0, min(worldy, self.maxheight)))
+    
     def PixelsToWorld(self, coord, axis):
         """convert from pixels to world units.
          coord is a single value and axis denoted
@@ -757,77 +1218,324 @@ class Canvas(wx.Window):
             return (coord / self.factor) + self.xoffset
         elif axis == 'yaxis':
             return (coord / self.factor) + self.yoffset
+    
+    def WorldToPixelsXY(self, xs, ys):
+        """convert many points from world units to pixels in one go.
+         xs and ys are sequences of x and y coords. Returns
+         a list of (x, y) points"""
+        factor, xoffset, yoffset = self.factor, self.xoffset, self.yoffset
+        return [(int(x / factor + xoffset), int(y / factor + yoffset))
+                for x, y in izip(xs, ys)]
         
     def ProcessBG(self):
         """Process the image by resizing to best fit current size"""
-        image = self.frame.displayimage.image
-        imagewidth, imageheight = image.size
-        
-        # What drives the scaling - height or width
-        if imagewidth / imageheight > self.width / self.height:
-            self.scalingvalue = self.width / imagewidth
-        else:
-            self.scalingvalue = self.height / imageheight
+        displayimage = self.frame.displayimage
+        
+        # a new image, crop or rotation starts with the whole image
+        viewkey = (displayimage.filepath, tuple(displayimage.cropframe),
+                   displayimage.rotation % 4)
+        if viewkey != self.viewkey:
+            self.viewkey = viewkey
+            self.zoom = 1
+        
+        # zoomed in beyond the decoded resolution - draw from the image
+        # at full resolution, with the decoded image as the preview.
+        # World coords do not change as the image height is still 1000 units
+        image = preview = displayimage.image
+        if self.zoom > 1 and self.FitScale(image) * self.zoom > 1:
+            image = displayimage.ZoomSource()
+        if image is preview:
+            preview = None
         
+        imagewidth, imageheight = image.size
+        self.scalingvalue = self.FitScale(image) * self.zoom
                 
-        # resize with antialiasing
         self.resized_width =  int(imagewidth * self.scalingvalue)
         self.resized_height = int(imageheight * self.scalingvalue)
-        self.resizedimage = image.resize((self.resized_width,
-                                          self.resized_height)
-                                             , Image.ANTIALIAS)
         
         # factor chosen so that image ht = 1000 U
         self.factor = self.maxheight / self.resized_height
         
-        # blit the image centerd in x and y axes
-        self.bmp = self.ImageToBitmap(self.resizedimage)
-        self.imagedc = wx.MemoryDC()
-        self.imagedc.SelectObject(self.bmp)
+        if self.zoom > 1:
+            # background is drawn from tiles when rendering
+            self.bgkey = None
+            if (self.pyramid is None or self.pyramid.image is not image or
+                self.pyramid.preview is not preview):
+                self.pyramid = TilePyramid(image,
+                                           cachesize=self.tile_cache_size,
+                                           preview=preview)
+            centerx, centery = self.center
+            self.xoffset = int(round(self.width / 2 - centerx / self.factor))
+            self.yoffset = int(round(self.height / 2 - centery / self.factor))
+            return
+        self.pyramid = None
+        
+        # the fitted bitmap depends only on the file, crop, rotation
+        # and the size it is fitted to
+        key = (displayimage.filepath, tuple(displayimage.cropframe),
+               displayimage.rotation % 4,
+               self.resized_width, self.resized_height)
+        self.bgkey = key
+        bmp = self.bitmapcache.get(key)
+        if bmp is None:
+            size = (self.resized_width, self.resized_height)
+            if imagewidth * imageheight > self.progressive_pixels:
+                # quick preview now, antialiased version when ready
+                # - not cached, it will be replaced soon
+                bmp = self.ImageToBitmap(image.resize(size, Image.NEAREST))
+                self.resampler.resample(key, image, size)
+            else:
+                # resize with antialiasing
+                bmp = self.ImageToBitmap(image.resize(size, Image.ANTIALIAS))
+                self.bitmapcache.put(key, bmp)
+        
+        self.SetBackground(bmp)
         
+        # blit the image centerd in x and y axes
         self.xoffset = (self.width-self.resized_width)/2
         self.yoffset = (self.height-self.resized_height)/2
+    
+    def FitScale(self, image):
+        """Scaling for image to fit the canvas"""
+        imagewidth, imageheight = image.size
+        
+        # What drives the scaling - height or width
+        if imagewidth / imageheight > self.width / self.height:
+            return self.width / imagewidth
+        else:
+            return self.height / imageheight
+    
+    def SetBackground(self, bmp):
+        """Use bmp as the background image"""
+        # bitmap may be in the cache - release it from the old dc first
+        if self.bmp:
+            self.imagedc.SelectObject(wx.NullBitmap)
+        self.bmp = bmp
+        self.imagedc = wx.MemoryDC()
+        self.imagedc.SelectObject(self.bmp)
+    
+    def OnResampled(self, key, resizedimage):
+        """Called from the resampler thread when the antialiased
+        image is ready. Only hand it over - bitmaps are made in the
+        main thread on the next idle event"""
+        self._resampled = (key, resizedimage)
+        wx.WakeUpIdle()
+    
+    def SwapResampled(self):
+        """Replace the quick preview with the antialiased image"""
+        key, resizedimage = self._resampled
+        self._resampled = None
+        
+        bmp = self.ImageToBitmap(resizedimage)
+        self.bitmapcache.put(key, bmp)
+        
+        # canvas may have moved on to another size or image
+        if key == self.bgkey:
+            self.SetBackground(bmp)
+            self._FGchanged = True # redraw with same geometry
             
     def Draw(self, dc):
         """Redraw the background and foreground elements"""
-        # blit the buffer on to the screen - BG
-        dc.Blit(self.xoffset, self.yoffset,
-                self.resized_width, self.resized_height, self.imagedc, 0, 0)
-        
-        # draw the calipers
-        for caliper in self.caliperlist:
-            caliper.draw(dc)
+        # static layer has to be redone as something in it has changed
+        self.RenderStatic()
+        dc.DrawBitmap(self.staticbmp, 0, 0)
         
-        # doodle lines
-        self.doodle.Draw(dc)
+        # and the live layer over it
+        self.DrawLive(dc)
         
         self._BGchanged = False 
         self._FGchanged = False
+        self._damaged = [] # all redrawn
         #self._doodlechanged = False
     
+    def LiveCalipers(self):
+        """Calipers being positioned or moved - these are not
+        part of the static layer"""
+        if (self.activetool in ('caliper', 'calibrate') and
+            0 <= self.activecaliperindex < len(self.caliperlist)):
+            return [self.caliperlist[self.activecaliperindex]]
+        return []
+    
+    def DrawLive(self, dc, rect=None):
+        """Draw the live layer - the calipers being moved, the
+        highlight on a hittable caliper and the doodle line being drawn.
+        If rect is given, only what can overlap it is drawn"""
+        live = self.LiveCalipers()
+        for caliper in live:
+            if rect is None or caliper.GetBoundingBox().Intersects(rect):
+                caliper.draw(dc)
+        
+        caliper = self.hitcaliper
+        if (caliper and caliper.highlight and caliper not in live and
+            caliper in self.caliperlist):
+            if rect is None or caliper.GetBoundingBox().Intersects(rect):
+                caliper.DrawHighlight(dc)
+        
+        self.doodle.DrawLive(dc)
+    
+    def RenderStatic(self):
+        """Render the static layer from the background image
+        and all calipers and doodle lines that are not live"""
+        if (not self.staticbmp or self.staticbmp.GetWidth() != self.width
+            or self.staticbmp.GetHeight() != self.height):
+            self.staticbmp = wx.EmptyBitmap(self.width, self.height)
+        
+        dc = wx.MemoryDC()
+        dc.SelectObject(self.staticbmp)
+        dc.SetBackground(wx.WHITE_BRUSH)
+        dc.Clear()
+        
+        if self.zoom > 1:
+            self.DrawTiles(dc)
+        else:
+            dc.Blit(self.xoffset, self.yoffset, self.resized_width,
+                    self.resized_height, self.imagedc, 0, 0)
+        
+        live = self.LiveCalipers()
+        for caliper in self.caliperlist:
+            if caliper not in live:
+                caliper.draw(dc)
+        self.doodle.Draw(dc)
+        
+        dc.SelectObject(wx.NullBitmap)
+    
+    def OnTileMade(self, pyramid, level, col, row):
+        """Called from the tile maker thread when a tile is ready.
+        The tiles are drawn in the main thread on the next idle event"""
+        if pyramid is self.pyramid:
+            self._tilesmade = True
+            wx.WakeUpIdle()
+    
+    def DrawTiles(self, dc):
+        """Draw the visible part of the zoomed image from
+        tiles of the pyramid level closest to the zoom. Tiles not
+        made yet are drawn from the preview and asked for"""
+        pyramid = self.pyramid
+        scale = self.scalingvalue
+        level = pyramid.level_for(scale)
+        
+        # visible part of the image, in image pixels
+        visible = (-self.xoffset / scale, -self.yoffset / scale,
+                   (self.width - self.xoffset) / scale,
+                   (self.height - self.yoffset) / scale)
+        
+        imagekey = self.viewkey + (pyramid.image.size,)
+        missing = []
+        for col, row in pyramid.tiles_in(level, visible):
+            # tile edges are rounded relative to the image origin so
+            # that tile bitmaps are the same whatever the panning
+            x1, y1, x2, y2 = pyramid.tile_rect(level, col, row)
+            left, top = int(round(x1 * scale)), int(round(y1 * scale))
+            width = int(round(x2 * scale)) - left
+            height = int(round(y2 * scale)) - top
+            if width <= 0 or height <= 0:
+                continue
+            
+            key = imagekey + (level, col, row, width, height)
+            bmp = self.bitmapcache.get(key)
+            if bmp is None:
+                tile = pyramid.ready(level, col, row)
+                if tile is not None:
+                    bmp = self.ImageToBitmap(tile.resize((width, height),
+                                                         Image.ANTIALIAS))
+                    self.bitmapcache.put(key, bmp)
+            if bmp is None:
+                missing.append((level, col, row))
+                key = key + ('preview',)
+                bmp = self.bitmapcache.get(key)
+                if bmp is None:
+                    tile = pyramid.from_preview(level, col, row)
+                    bmp = self.ImageToBitmap(tile.resize((width, height),
+                                                         Image.BILINEAR))
+                    self.bitmapcache.put(key, bmp)
+            dc.DrawBitmap(bmp, self.xoffset + left, self.yoffset + top)
+        
+        # even if empty, so that tiles no longer in view are not made
+        self.tilemaker.request(pyramid, missing)
+    
+    def AddToStatic(self, draw):
+        """Something has become static without changing its look, eg.
+        a caliper being fixed. Instead of rendering the static layer
+        again, draw(dc) is called to draw just that on to it"""
+        if not self.staticbmp:
+            return
+        dc = wx.MemoryDC()
+        dc.SelectObject(self.staticbmp)
+        draw(dc)
+        dc.SelectObject(wx.NullBitmap)
+    
+    def Damage(self, rect):
+        """Mark a rect (in pixels) as needing redraw on next idle event"""
+        self._damaged.append(rect)
+    
+    def DrawDamaged(self):
+        """Redraw only the damaged part of the canvas - the static layer
+        within it and the live layer over it. All the changes since the
+        last idle event go to the screen in one blit"""
+        rect = self._damaged[0]
+        for damaged in self._damaged[1:]:
+            rect = rect.Union(damaged)
+        self._damaged = []
+        
+        # limit to the canvas
+        left, top = max(rect.x, 0), max(rect.y, 0)
+        right = min(rect.x + rect.width, self.width)
+        bottom = min(rect.y + rect.height, self.height)
+        if right <= left or bottom <= top:
+            return
+        rect = wx.Rect(left, top, right - left, bottom - top)
+        
+        dc = wx.MemoryDC()
+        dc.SelectObject(self.buffer)
+        dc.SetClippingRect(rect)
+        
+        staticdc = wx.MemoryDC()
+        staticdc.SelectObject(self.staticbmp)
+        dc.Blit(rect.x, rect.y, rect.width, rect.height,
+                staticdc, rect.x, rect.y)
+        staticdc.SelectObject(wx.NullBitmap)
+        
+        self.DrawLive(dc, rect)
+        
+        dc.DestroyClippingRegion()
+        
+        # and on to the screen
+        wx.ClientDC(self).Blit(rect.x, rect.y, rect.width, rect.height,
+                               dc, rect.x, rect.y)
+        dc.SelectObject(wx.NullBitmap)
+    
     def DrawDoodle(self, dc):
         """Draw the doodle lines without redrawing everything else"""
         self.doodle.Draw(dc)
         #self._doodlechanged = False
     
     def ClearDoodle(self , event):
-        self.doodle.lines = []
+        self.doodle.Clear()
         self._FGchanged = True
         #self._doodlechanged = True
     
     def resetFG(self):
         """When the coords are not preserved, reset all
         foreground elements to default"""
-        self.doodle.lines = []
+        self.doodle.Clear()
         self.caliperlist = []
         self.calibration = 0
         self.frame.SetStatusText("Not calibrated", 2)
         
     def ImageToBitmap(self, img):
+        """Convert a PIL image to a bitmap. The RGB data is handed
+        to the bitmap as a buffer, without going through a wx.Image"""
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        
+        if hasattr(wx, 'BitmapFromBuffer'):
+            return wx.BitmapFromBuffer(img.size[0], img.size[1],
+                                       image_data(img))
+        
+        # older wxPython
         newimage = apply(wx.EmptyImage, img.size)
-        newimage.SetData(img.convert( "RGB").tostring())
-        bmp = newimage.ConvertToBitmap()
-        return bmp
+        newimage.SetData(image_data(img))
+        return newimage.ConvertToBitmap()
     
     def NewCaliper(self, event):
         """Start a new caliper"""
@@ -835,6 +1543,15 @@ class Canvas(wx.Window):
         self.activecaliperindex = len(self.caliperlist)-1
         self.activetool = "caliper"
 
+    def SetCalipers(self, positions):
+        """Replace the calipers with ones placed at positions,
+        a list of (x1, x2, y2) in world coords"""
+        self.caliperlist = [Caliper(self, self.caliper_shape, position)
+                            for position in positions]
+        self.activecaliperindex = len(self.caliperlist)-1
+        self.caliperindex.invalidate()
+        self._FGchanged = True
+        
     def RemoveAllCalipers(self, event):
         """Remove all the existing calipers"""
         self.caliperlist = []
@@ -851,13 +1568,21 @@ class Canvas(wx.Window):
         """Find the object that is hittable.
         This is the object within a defined distance from the given coords"""
         # find if any caliper is hittable
-        for caliperindex, caliper in enumerate(self.caliperlist):
-            hittable = caliper.isHittable(worldx, worldy)
-            if hittable > 0:
-                return (caliper, caliperindex, hittable)
+        self.caliperindex.update(self.caliperlist)
+        return self.caliperindex.find(worldx, worldy)
+    
+    def MarkHitObject(self, caliper, hit_type):
+        """Highlight the caliper that can be hit, and remove
+        the highlight from the one that could be hit before"""
+        if caliper is self.hitcaliper and (caliper is None or
+                                           caliper.highlight == hit_type):
+            return
         
-        # if nothing is hit
-        return (None, 0, 0)
+        if self.hitcaliper:
+            self.hitcaliper.MarkAsHittable(0) # remove the highlight
+        if caliper:
+            caliper.MarkAsHittable(hit_type)
+        self.hitcaliper = caliper
     
     def ToggleDoodle(self, event):
         """Toggle doodle on or off"""
@@ -890,6 +1615,50 @@ class Canvas(wx.Window):
             return [imageheight-y2, x1, imageheight-y1, x2]
             
        
+#------------------------------------------------------------------------------
+class MotionEvent():
+    """A copy of the state of a mouse motion event, to be handled
+    later. wx reuses event objects, so they cannot be kept"""
+    def __init__(self, event):
+        self.position = event.GetPosition()
+        self.moving = event.Moving()
+        self.dragging = event.Dragging()
+        self.leftisdown = event.LeftIsDown()
+    
+    def GetPosition(self):
+        return self.position
+    
+    def GetX(self):
+        return self.position.x
+    
+    def GetY(self):
+        return self.position.y
+    
+    def GetEventType(self):
+        return wx.wxEVT_MOTION
+    
+    def Moving(self):
+        return self.moving
+    
+    def Dragging(self):
+        return self.dragging
+    
+    def LeftIsDown(self):
+        return self.leftisdown
+    
+    # a motion event has no button changes
+    def LeftDown(self):
+        return False
+    
+    def LeftUp(self):
+        return False
+    
+    def RightDown(self):
+        return False
+    
+    def RightUp(self):
+        return False
+    
 #------------------------------------------------------------------------------
 
 class DisplayImage():
@@ -919,24 +1688,44 @@ class DisplayImage():
         # data saved with image
         self.data = None #ToDO : may not require
         
+        # calipers kept from the previous image are not saved with this one
+        self.carriedcalipers = []
+        
+        # for zooming in past the decoded resolution - the cropped and
+        # rotated image at full resolution as (viewkey, source), source
+        # being a MappedView, a decoded image or None until decoded,
+        # and the view being decoded at full resolution in the background
+        self.zoomsource = None
+        self.fullrequest = None
+        
+        # images are decoded at reduced scale where possible, just large
+        # enough to fill the screen. Full resolution is loaded only when
+        # needed (for cropping)
+        self.targetsize = wx.GetDisplaySize()
+        self.fullsize = (0, 0)
+        self.reduction = (1, 1) # full resolution px per decoded px
+        
     def LoadAndDisplayImage(self, filepath):
         """Load a new image and display"""
-        self.filepath = filepath
-
         # handle .plst files
-        if self.filepath.endswith('.plst'):
+        if filepath.endswith('.plst'):
             try:
-                self.filepath = self.frame.playlist.playlist[0]
+                filepath = self.frame.playlist.playlist[0]
             except IndexError:
                 self.frame.DisplayMessage("Empty playlist")
                 return
             
-        try:        
-            self.uncropped_image = Image.open(self.filepath, 'r')
-        except:
+        # from the cache if it has been prefetched
+        cached = self.frame.prefetcher.get(filepath)
+        if cached is None:
             # TODO: catch specific errors and display error message
             self.frame.DisplayMessage("Could not load image")
             return
+        self.filepath = filepath
+        self.fullrequest = None
+        self.uncropped_image = cached.uncropped_image
+        self.fullsize = cached.fullsize
+        self.reduction = cached.reduction
 
         # load saved information
         self.ResetData()
@@ -944,14 +1733,16 @@ class DisplayImage():
         
         # crop image as per saved frame
         if self.iscropped:
-            self.image = self.uncropped_image.crop(self.cropframe)
             self.frame.toolbar.ToggleTool(ID_CROP, 1)
-            #self.image = self.CropImage(self.cropframe, "image")
+
+        # use the prepared image unless the saved data has changed since
+        if (cached.cropframe == self.cropframe and
+            cached.rotation == self.rotation % 4):
+            self.image = cached.image
         else:
-            self.image = self.uncropped_image
-        
-        # rotate image to match saved rotation
-        self.image = self.Rotate(self.image, self.rotation)
+            self.image = self.PrepareDisplay(self.uncropped_image,
+                                             self.cropframe, self.rotation,
+                                             self.reduction)
             
         self.canvas._BGchanged = True
         
@@ -962,14 +1753,118 @@ class DisplayImage():
         else:
             self.frame.SetStatusText("Not Calibrated", 2)
     
+    def PrepareImage(self, filepath):
+        """Decode the image at filepath and prepare it for display
+        as per its saved data. Does not touch any of the current
+        state, so can be called from the prefetch threads"""
+        data = self.ReadImageData(filepath) or self.defaultdata
+        cropframe = list(data.get("cropframe", [0,0,0,0]))
+        rotation = data.get("rotation", 0)
+        
+        # a screen sized version may be on disk from an earlier session
+        width, height = self.targetsize
+        variant = 'display %dx%d %s' % (width, height,
+                                        ','.join(map(str, cropframe)))
+        stored = self.frame.diskcache.get(filepath, variant)
+        if stored:
+            uncropped_image, fullsize = stored
+        else:
+            # uncompressed files are read only as far as needed
+            raster = open_mapped(filepath)
+            if raster is not None:
+                try:
+                    return self.PrepareMapped(filepath, raster, variant,
+                                              cropframe, rotation)
+                finally:
+                    raster.close()
+            
+            # decode only at the resolution needed to fill the screen
+            uncropped_image, fullsize = load_image(filepath, self.targetsize,
+                                                   cropframe)
+            uncropped_image = reduce_image(uncropped_image, fullsize,
+                                           self.targetsize, cropframe)
+            if uncropped_image.size != fullsize:
+                self.frame.diskcache.put(filepath, variant,
+                                         uncropped_image, fullsize)
+        cached = CachedImage(uncropped_image, None, cropframe, rotation,
+                             fullsize)
+        cached.image = self.PrepareDisplay(uncropped_image, cropframe,
+                                           rotation, cached.reduction)
+        return cached
+    
+    def PrepareMapped(self, filepath, raster, variant, cropframe, rotation):
+        """Prepare an image read through a memory map. The uncropped
+        image is only made large enough for the whole image to fill the
+        screen, and the cropped part is read separately at the
+        resolution it needs, so the full raster is never in memory"""
+        fullsize = raster.size
+        uncropped_image = raster.reduced(draft_size(fullsize,
+                                                    self.targetsize))
+        cached = CachedImage(uncropped_image, None, cropframe, rotation,
+                             fullsize)
+        
+        if cropframe != [0,0,0,0]:
+            # same scale as a draft decode for this crop would have
+            x1, y1, x2, y2 = raster.clip(cropframe)
+            scale = draft_size(fullsize, self.targetsize,
+                               cropframe)[0] / fullsize[0]
+            size = (max(1, int(math.ceil((x2 - x1) * scale))),
+                    max(1, int(math.ceil((y2 - y1) * scale))))
+            image = raster.reduced(size, cropframe)
+        else:
+            image = uncropped_image
+            if uncropped_image.size != fullsize:
+                self.frame.diskcache.put(filepath, variant,
+                                         uncropped_image, fullsize)
+        
+        cached.image = self.Rotate(image, rotation)
+        return cached
+
+    def PrepareDisplay(self, uncropped_image, cropframe, rotation,
+                       reduction=(1, 1)):
+        """Crop and rotate the image as per the given data. cropframe is
+        in full resolution pixels and reduction is the number of full
+        resolution pixels per pixel of uncropped_image"""
+        if cropframe != [0,0,0,0]:
+            image = uncropped_image.crop(scale_frame(cropframe, reduction))
+            image.load() # crop may be lazy
+        else:
+            image = uncropped_image
+            
+        return self.Rotate(image, rotation)
+    
+    def GetDataFilePath(self, filepath):
+        """Path to the file holding stored data for the image.
+        See annotation_store for the format"""
+        return data_path(filepath)
+    
+    def ReadImageData(self, filepath):
+        """Read the stored data for an image. Returns None
+        if there is no stored data or it cannot be read"""
+        datafile = self.GetDataFilePath(filepath)
+        
+        # may have been saved but not written yet
+        data = self.frame.annotationwriter.get(datafile)
+        if data is not None:
+            return data
+        
+        # loaded with the playlist
+        found, data = self.frame.annotationindex.find(filepath)
+        if found:
+            return data
+        
+        # data saved by older versions is read too
+        try:
+            return read_data(filepath)
+        except:
+            return None
+    
     def LoadImageData(self):
         """Load the stored data for the image at filepath"""
-        # data is stored pickled with pathname same as image with
-        # '.' in front (hidden on Linux) and '.pkl' as extension
-        self.datafile = os.path.join(os.path.dirname(self.filepath),
-                  "."+os.path.splitext(os.path.basename(self.filepath))[0]+".pkl")
-        if os.path.exists(self.datafile):
-            self.data = pickle.load(open(self.datafile,'r'))
+        self.datafile = self.GetDataFilePath(self.filepath)
+        data = self.ReadImageData(self.filepath)
+        if data is not None:
+            self.data = dict(data) # changed in place when saving
        
         # load the variables with default vals if key does not exist
         self.note = self.data.get("note", '')
@@ -983,8 +1878,31 @@ class DisplayImage():
         
         if self.cropframe != [0,0,0,0]:
             self.iscropped = True
+        
+        # calipers and doodle are stored packed, and only
+        # unpacked for images that have them
+        try:
+            calipers = doodle = None
+            if "calipers" in self.data:
+                calipers = unpack_calipers(self.data["calipers"])
+            if "doodle" in self.data:
+                doodle = StrokeList.fromstring(self.data["doodle"])
+        except FormatError:
+            calipers = doodle = None
+            self.frame.DisplayMessage("Could not read calipers and doodle")
+        
+        if calipers is not None:
+            self.canvas.SetCalipers(calipers)
+            self.carriedcalipers = [] # all belong to this image
+        else:
+            self.carriedcalipers = list(self.canvas.caliperlist)
+        if doodle is not None:
+            self.canvas.doodle.lines = doodle
+            self.canvas._FGchanged = True
             
-        self.loaded_data = copy.deepcopy(self.data)
+        # to find out if the data has changed when saving. The values
+        # are replaced, not changed in place, so a shallow copy will do
+        self.loaded_data = dict(self.data)
         
     def ResetData(self):
         """Reset image data when new image is loaded"""
@@ -1001,7 +1919,8 @@ class DisplayImage():
         self.frame.toolbar.ToggleTool(ID_DOODLE, 0)
         
     def SaveImageData(self):
-        """Save the image data - but only if data has changed"""
+        """Save the image data - but only if data has changed.
+        It is written in the background"""
         # if data is None, initialise as empty dict
         if not self.data:
             self.data = {}
@@ -1011,30 +1930,31 @@ class DisplayImage():
         self.data["calibration"] = self.canvas.calibration
         self.data["rotation"] = self.rotation % 4 # modulo 4 - remove extra loops
         self.data["cropframe"] = self.cropframe
+        
+        # finished calipers made on this image, not the calibration caliper
+        calipers = [(caliper.x1, caliper.x2, caliper.y2)
+                    for caliper in self.canvas.caliperlist
+                    if caliper.state == 3 and
+                    not isinstance(caliper, CalibrateCaliper) and
+                    caliper not in self.carriedcalipers]
+        self.SetPacked("calipers", calipers and pack_calipers(calipers))
+        doodle = self.canvas.doodle.lines
+        self.SetPacked("doodle", len(doodle) and doodle.tostring())
 
         # save data if it has changed
         if self.data != self.loaded_data:
-            try:
-                #if os.name == 'posix':
-                if self.frame.platform in ['linux', 'mac']:
-                    pickle.dump(self.data, open(self.datafile, 'w'))
-
-                # in windows, set file attribute to hidden
-                #elif os.name == 'nt':
-                elif self.frame.platform == 'windows':
-                    ## have to remove the hidden file because it doesnt have
-                    ## write permission
-                    if os.path.exists(self.datafile):
-                        os.remove(self.datafile)  
-                    pickle.dump(self.data, open(self.datafile, 'w'))
-                    status = os.popen("attrib +h \"%s\"" %(self.datafile))
-                    if status != 0:
-                        pass
-
-            except:
-                self.frame.DisplayMessage("Could not save image data for %s" %(
-                        os.path.basename(self.filepath)))
-                
+            self.frame.annotationwriter.save(self.datafile, dict(self.data))
+            self.frame.annotationindex.update(self.filepath, dict(self.data))
+            self.frame.listbox.Refresh() # badges may have changed
+            self.loaded_data = dict(self.data)
+        
+    def SetPacked(self, key, value):
+        """Store a packed value in the image data, leaving
+        out the key if there is nothing to store"""
+        if value:
+            self.data[key] = value
+        elif key in self.data:
+            del self.data[key]
         
     def SaveImage(self, event):
         """
@@ -1134,8 +2054,10 @@ class DisplayImage():
                      cropframe[1] - self.canvas.yoffset,
                      cropframe[2] - self.canvas.xoffset,
                      cropframe[3] - self.canvas.yoffset]
-        self.cropframe = [int(coord/self.canvas.scalingvalue)
-                                      for coord in cropframe]
+        # scaling of this image - when zoomed in, the canvas may be
+        # drawing from the full resolution image instead
+        scalingvalue = self.canvas.FitScale(self.image) * self.canvas.zoom
+        self.cropframe = [int(coord/scalingvalue) for coord in cropframe]
 
         # correct cropframe for current rotation of canvas so that cropframe
         # applies to unrotated image
@@ -1154,27 +2076,129 @@ class DisplayImage():
             if val < 0:
                 self.cropframe[ind] = 0
         
-        # now crop and rotate
-        cropped_image = self.uncropped_image.crop(self.cropframe)
+        # so far in pixels of the decoded image - convert to
+        # full resolution pixels, which is what is saved
+        xreduction, yreduction = self.reduction
+        self.cropframe = [int(self.cropframe[0] * xreduction),
+                          int(self.cropframe[1] * yreduction),
+                          int(self.cropframe[2] * xreduction),
+                          int(self.cropframe[3] * yreduction)]
+        
+        # now crop and rotate - at full resolution as the
+        # cropped part will be enlarged to fill the canvas
+        cropped_image = self.LoadCropped()
         cropped_rotated_image = self.Rotate(cropped_image, self.rotation)
         
         self.iscropped = True
         self.canvas._BGchanged = True
         
         return cropped_rotated_image
+    
+    def LoadCropped(self):
+        """The part of the image within cropframe at full resolution.
+        It is read from the file, so the whole image is not decoded
+        at full resolution if it can be avoided"""
+        if self.reduction != (1, 1):
+            try:
+                return load_region(self.filepath, self.cropframe)
+            except:
+                # stay with the reduced image
+                self.frame.DisplayMessage(
+                    "Could not load full resolution image")
+        
+        cropped_image = self.uncropped_image.crop(scale_frame(self.cropframe,
+                                                              self.reduction))
+        cropped_image.load() # crop may be lazy
+        return cropped_image
+    
+    def ZoomSource(self):
+        """The image to zoom into, at full resolution if it can be had
+        without holding up the display. Uncompressed rasters are read
+        a part at a time through a memory map. Other images are decoded
+        at full resolution in the background, and the decoded image is
+        used until that is done. The decoded image stays as the display
+        image either way"""
+        if self.reduction == (1, 1):
+            return self.image
+        
+        viewkey = (self.filepath, tuple(self.cropframe), self.rotation % 4)
+        if self.zoomsource is None or self.zoomsource[0] != viewkey:
+            self.CloseZoomSource()
+            raster = open_mapped(self.filepath)
+            if raster is None:
+                self.zoomsource = (viewkey, None)
+                self.LoadFullResolution(viewkey)
+            else:
+                self.zoomsource = (viewkey, MappedView(raster, self.cropframe,
+                                                       self.rotation))
+        if self.zoomsource[1] is not None:
+            return self.zoomsource[1]
+        return self.image
+    
+    def CloseZoomSource(self):
+        """Release the file mapped or image decoded for zooming"""
+        if self.zoomsource and isinstance(self.zoomsource[1], MappedView):
+            self.zoomsource[1].close()
+        self.zoomsource = None
+    
+    def LoadFullResolution(self, viewkey):
+        """Start decoding the image at full resolution in the background,
+        cropped and rotated as in viewkey. Only tried once each time
+        the image is shown"""
+        if self.fullrequest == viewkey:
+            return
+        self.fullrequest = viewkey
+        loader = threading.Thread(target=self._LoadFullResolution,
+                                  args=(viewkey, list(self.cropframe),
+                                        self.rotation))
+        loader.setDaemon(True)
+        loader.start()
+    
+    def _LoadFullResolution(self, viewkey, cropframe, rotation):
+        """Decode and prepare the image at full resolution.
+        Runs in its own thread"""
+        try:
+            uncropped_image, fullsize = load_image(viewkey[0])
+            source = self.PrepareDisplay(uncropped_image, cropframe, rotation)
+        except:
+            source = None
+        wx.CallAfter(self.OnFullResolution, viewkey, source)
+    
+    def OnFullResolution(self, viewkey, source):
+        """The full resolution decode is done, zoom into it if the
+        image is still being shown as it was"""
+        if self.zoomsource is None or self.zoomsource[0] != viewkey:
+            return
+        if source is None:
+            # stay with the reduced image
+            self.frame.DisplayMessage("Could not load full resolution image")
+            return
+        
+        self.zoomsource = (viewkey, source)
+        self.canvas._BGchanged = True
         
     def CloseImage(self):
         """Things to do before closing image"""
         self.SaveImageData()
+        self.CloseZoomSource()
+        
+        # keep the image as currently prepared so that coming
+        # back to it does not need a decode, crop or rotate
+        self.frame.imagecache.put(self.filepath,
+                                  CachedImage(self.uncropped_image, self.image,
+                                              self.cropframe, self.rotation,
+                                              self.fullsize))
         # TODO: based in user preference may clear calipers
 
 #------------------------------------------------------------------------------
 class Caliper():
     """Caliper is a tool with two vertical lines connected by a bridge"""
-    def __init__(self, canvas, shape='full'):
+    def __init__(self, canvas, shape='full', position=None):
         """
         Full caliper is as shown below
         Truncated caliper (shape = 'truncated') has short legs
+        If position (x1, x2, y2) is given, the caliper is placed there
+        already positioned, otherwise it starts at the mouse
         """
         self.canvas = canvas
         self.shape = shape
@@ -1187,11 +2211,14 @@ class Caliper():
         #         x1,y3     x2,y3
         #
         # Initialise position to mouse position
-        pos = self.canvas.ScreenToClient(wx.GetMousePosition())
-        mousex, mousey = (self.canvas.PixelsToWorld(pos.x, 'xaxis'),
-                          self.canvas.PixelsToWorld(pos.y, 'yaxis'))        
-        self.x1 = self.x2 = mousex
-        self.y2 = mousey
+        if position is None:
+            pos = self.canvas.ScreenToClient(wx.GetMousePosition())
+            mousex, mousey = (self.canvas.PixelsToWorld(pos.x, 'xaxis'),
+                              self.canvas.PixelsToWorld(pos.y, 'yaxis'))        
+            self.x1 = self.x2 = mousex
+            self.y2 = mousey
+        else:
+            self.x1, self.x2, self.y2 = position
         self.y1, self.y3 = 0, canvas.maxheight
         
         self.pen = wx.Pen(self.canvas.caliper_color, self.canvas.caliper_width, wx.SOLID)
@@ -1202,10 +2229,12 @@ class Caliper():
         # 3 - positioned both caliperlegs, 4 - repositioning whole caliper
         # cycle 1 -> 2 -> 3 -> 2 or 4 -> 3
         self.state = 1
+        if position is not None:
+            self.state = 3
         
         # range from mouse to be hittable
         self.hitrange = 10
-        self.was_hittable = False # true if it becomes hittable
+        self.highlight = 0 # part marked as hittable, see MarkAsHittable
         # distance between legs
         self.measurement = 0
 
@@ -1236,6 +2265,29 @@ class Caliper():
         
         self.MeasureAndDisplay(dc)
         dc.EndDrawing()
+    
+    def GetBoundingBox(self):
+        """The rect in pixels covering the caliper and its measurement"""
+        x1 = self.canvas.WorldToPixels(min(self.x1, self.x2), "xaxis")
+        x2 = self.canvas.WorldToPixels(max(self.x1, self.x2), "xaxis")
+        y1 = self.canvas.WorldToPixels(min(self.y1, self.y2 - 40), "yaxis")
+        y3 = self.canvas.WorldToPixels(max(self.y3, self.y2 + 40), "yaxis")
+        
+        # text starts at the middle and goes right and down
+        textwidth, textheight = self.canvas.textextent
+        margin = self.canvas.caliper_width + 2
+        left = x1 - margin
+        right = max(x2, (x1 + x2) / 2 + textwidth) + margin
+        top = y1 - margin
+        bottom = y3 + textheight + margin
+        
+        return wx.Rect(int(left), int(top),
+                       int(right - left) + 1, int(bottom - top) + 1)
+    
+    def Invalidate(self):
+        """Mark the area of the caliper as needing redraw"""
+        self.canvas.Damage(self.GetBoundingBox())
+        self.canvas.caliperindex.invalidate() # may have moved
         
     def MeasureAndDisplay(self, dc):
         # write measurement
@@ -1273,9 +2325,10 @@ class Caliper():
         
         # beginning - this is first caliper being positioned
         elif event.Moving() and self.state == 1:
+            self.Invalidate() # old position
             self.x1 = self.x2 = mousex
             self.y2 = mousey
-            self.canvas._FGchanged = True
+            self.Invalidate() # new position
         
         # fix the first caliper
         elif event.LeftDown() and self.state == 1:
@@ -1283,23 +2336,26 @@ class Caliper():
             
         # positioning second caliper
         elif event.Moving() and self.state == 2:
+            self.Invalidate()
             self.x2 = mousex
             self.y2 = mousey
-            self.canvas._FGchanged = True
+            self.Invalidate()
             
         # fix second caliper
         elif event.LeftDown() and self.state == 2:
             self.state = 3
             self.canvas.SetCursor(wx.StockCursor(self.canvas.cursors[0]))
-            self.OnCompletion()
             self.canvas.activetool = None
+            self.canvas.AddToStatic(self.draw) # no longer live
+            self.OnCompletion()
         
         # move whole caliper
         elif event.Moving() and self.state == 4:
+            self.Invalidate()
             self.x1 = mousex - self.x1offset
             self.x2 = mousex + self.x2offset
             self.y2 = mousey
-            self.canvas._FGchanged = True
+            self.Invalidate()
         
         # stop moving whole caliper
         elif event.LeftDown() and self.state == 4:
@@ -1307,6 +2363,7 @@ class Caliper():
             self.canvas.SetCursor(wx.StockCursor(self.canvas.cursors[0]))
             self.canvas.activetool = None
             self.activetool = None
+            self.canvas.AddToStatic(self.draw) # no longer live
         
         else:
             pass
@@ -1314,33 +2371,29 @@ class Caliper():
     def isHittable(self, worldx, worldy):
         """Is it within hitting range from current mouse position"""
         if abs(worldx - self.x1) < self.hitrange:
-            if not self.was_hittable:
-                self.MarkAsHittable(1)
             return 1 #first leg
         
         elif abs(worldx - self.x2) < self.hitrange:
-            if not self.was_hittable:
-                self.MarkAsHittable(2)
             return 2 #second leg
         
         elif abs(worldy - self.y2) < self.hitrange and \
-             sorted([worldx, self.x1, self.x2])[1] == worldx:
+             (self.x1 <= worldx <= self.x2 or self.x2 <= worldx <= self.x1):
             # if mouse x is between x1 and x2
-            if not self.was_hittable:
-                self.MarkAsHittable(3)
             return 3 #horizontal (whole caliper)
         
         else:
-            if self.was_hittable:
-                self.was_hittable = False
-                self.canvas._FGchanged = True
             return 0
         
     def MarkAsHittable(self, type):
-        """Mark caliper as hittable.
-        type is 1 for first leg, 2 for second leg and 3 for whole"""
-        dc = wx.BufferedDC(wx.ClientDC(self.canvas),
-                           self.canvas.buffer, wx.BUFFER_CLIENT_AREA)
+        """Mark caliper as hittable. type is 1 for first leg,
+        2 for second leg, 3 for whole and 0 to remove the mark.
+        The highlight is drawn with the live layer on next idle event"""
+        self.highlight = type
+        self.canvas.Damage(self.GetBoundingBox())
+        
+    def DrawHighlight(self, dc):
+        """Draw the part marked as hittable in the highlight color"""
+        type = self.highlight
         dc.BeginDrawing()
         dc.SetPen(self.hittable_pen)
         
@@ -1365,13 +2418,87 @@ class Caliper():
             dc.DrawLine(x1, y2, x2, y2) # horiz
         
         dc.EndDrawing()
-        self.was_hittable = True
         
     def OnCompletion(self):
         """Things to do on completion of one caliper.
         Only a placeholder here for now"""
         pass
     
+#------------------------------------------------------------------------------
+class CaliperIndex():
+    """Index of caliper legs and bridges sorted by position, so that
+    finding the caliper near the mouse does not need a check of
+    every caliper. Rebuilt only after calipers are added,
+    removed or moved"""
+    def __init__(self):
+        self.caliperlist = None
+        self.count = 0
+        self.dirty = True
+        
+        # leg x positions and bridge y positions, sorted, with the
+        # list index of the caliper for each
+        self.legx, self.legcalipers = [], []
+        self.bridgey, self.bridgecalipers = [], []
+        self.hitrange = 0 # largest hitrange of all calipers
+        
+    def invalidate(self):
+        """Calipers have changed position"""
+        self.dirty = True
+    
+    def update(self, caliperlist):
+        """Rebuild the index if the calipers have changed"""
+        if (not self.dirty and caliperlist is self.caliperlist and
+            len(caliperlist) == self.count):
+            return
+        
+        legs, bridges = [], []
+        self.hitrange = 0
+        for caliperindex, caliper in enumerate(caliperlist):
+            legs.append((caliper.x1, caliperindex))
+            legs.append((caliper.x2, caliperindex))
+            bridges.append((caliper.y2, caliperindex))
+            self.hitrange = max(self.hitrange, caliper.hitrange)
+        legs.sort()
+        bridges.sort()
+        
+        self.legx = [x for x, caliperindex in legs]
+        self.legcalipers = [caliperindex for x, caliperindex in legs]
+        self.bridgey = [y for y, caliperindex in bridges]
+        self.bridgecalipers = [caliperindex for y, caliperindex in bridges]
+        
+        self.caliperlist = caliperlist
+        self.count = len(caliperlist)
+        self.dirty = False
+        
+    def find(self, worldx, worldy):
+        """Return (caliper, caliperindex, hit_type) for the caliper that
+        can be hit at the given coords, or (None, 0, 0). As with checking
+        the calipers in turn, the first one in the list wins"""
+        best = self.count
+        
+        # legs within range of x
+        first = bisect_right(self.legx, worldx - self.hitrange)
+        last = bisect_left(self.legx, worldx + self.hitrange)
+        for position in xrange(first, last):
+            caliperindex = self.legcalipers[position]
+            if caliperindex < best and \
+                   self.caliperlist[caliperindex].isHittable(worldx, worldy):
+                best = caliperindex
+        
+        # bridges within range of y
+        first = bisect_right(self.bridgey, worldy - self.hitrange)
+        last = bisect_left(self.bridgey, worldy + self.hitrange)
+        for position in xrange(first, last):
+            caliperindex = self.bridgecalipers[position]
+            if caliperindex < best and \
+                   self.caliperlist[caliperindex].isHittable(worldx, worldy):
+                best = caliperindex
+        
+        if best == self.count: # if nothing is hit
+            return (None, 0, 0)
+        caliper = self.caliperlist[best]
+        return (caliper, best, caliper.isHittable(worldx, worldy))
+    
 #------------------------------------------------------------------------------
 class CalibrateCaliper(Caliper):
     """A special caliper used for calibration"""
@@ -1438,29 +2565,41 @@ class CalibrateCaliper(Caliper):
         
 #-------------------------------------------------------------------------
 class Doodle():
-    """Doodle on the image canvas"""
+    """Doodle on the image canvas.
+    Each line is a polyline of world coords x0, y0, x1, y1, ... so that
+    it can be converted and drawn in one go"""
     def __init__(self, parent):
-        self.lines = [] #list of doodle coords
+        self.lines = StrokeList() #doodle coords
+        self.current_line = None # line being drawn
         self.canvas = parent
         self.pen =wx.Pen(self.canvas.doodle_color, self.canvas.doodle_width, wx.SOLID)
         
     def Draw(self, dc):
         """Draw the lines for the doodle"""
+        self.DrawLines(dc, self.lines)
+    
+    def DrawLines(self, dc, lines):
+        """Draw the given doodle lines"""
         dc.SetPen(self.pen)
-        for line in self.lines: # line is a list of tuples
-            for coords in line:
-                x1 = self.canvas.WorldToPixels(coords[0], 'xaxis')
-                y1 = self.canvas.WorldToPixels(coords[1], 'yaxis')
-                x2 = self.canvas.WorldToPixels(coords[2], 'xaxis')
-                y2 = self.canvas.WorldToPixels(coords[3], 'yaxis')
-                dc.DrawLine(*(x1, y1, x2, y2))
+        for line in lines:
+            if len(line) < 4: # need at least two points
+                continue
+            dc.DrawLines(self.canvas.WorldToPixelsXY(line[0::2], line[1::2]))
                 
-    def DrawLine(self, coords):
-        """Draw the last bit of line"""
-        dc = wx.BufferedDC(wx.ClientDC(self.canvas), self.canvas.buffer,
-                               wx.BUFFER_CLIENT_AREA)
-        dc.SetPen(self.pen)
-        dc.DrawLine(*coords)
+    def DrawLive(self, dc):
+        """Draw the line being drawn, it is not in the static layer yet"""
+        if self.current_line:
+            self.DrawLines(dc, [self.current_line.coords])
+    
+    def GetBoundingBox(self, coords):
+        """The rect in pixels covering a line x0, y0, x1, y1..."""
+        points = self.canvas.WorldToPixelsXY(coords[0::2], coords[1::2])
+        xs = [x for x, y in points]
+        ys = [y for x, y in points]
+        margin = self.canvas.doodle_width + 1
+        return wx.Rect(min(xs) - margin, min(ys) - margin,
+                       max(xs) - min(xs) + 2 * margin + 1,
+                       max(ys) - min(ys) + 2 * margin + 1)
                 
     def handleMouseEvents(self, event):
         """Handle all mouse events when active"""
@@ -1469,40 +2608,51 @@ class Doodle():
                           self.canvas.PixelsToWorld(pos.y, 'yaxis'))
         if event.LeftDown():
             """Start a new line on left click"""
-            self.current_line = []
-            self.oldx = mousex
-            self.oldy = mousey
+            # points are simplified as they come in
+            self.current_line = StrokeSimplifier(mousex, mousey,
+                                                 self.canvas.doodle_tolerance)
         
-        elif event.Dragging() and event.LeftIsDown():
+        elif event.Dragging() and event.LeftIsDown() and self.current_line:
             """Draw the line"""
-            coords = (mousex, mousey, self.oldx, self.oldy)
-            
-            x1 = self.canvas.WorldToPixels(coords[0], 'xaxis')
-            y1 = self.canvas.WorldToPixels(coords[1], 'yaxis')
-            x2 = self.canvas.WorldToPixels(coords[2], 'xaxis')
-            y2 = self.canvas.WorldToPixels(coords[3], 'yaxis')
+            # the last point may be replaced by the new one, so
+            # the last segment has to be redrawn too
+            coords = self.current_line.coords
+            changed = list(coords[-4:]) + [mousex, mousey]
+            self.current_line.add(mousex, mousey)
             
-            # stored lines will have world coords - draw as pixels
-            self.current_line.append(coords)
-            self.DrawLine((x1, y1, x2, y2))
-
-            self.oldx = mousex
-            self.oldy = mousey
+            # drawn with the live layer on next idle event
+            self.canvas.Damage(self.GetBoundingBox(changed))
     
-        elif event.LeftUp():
+        elif event.LeftUp() and self.current_line:
             """End current line"""
-            self.lines.append(self.current_line)    
+            coords = self.current_line.coords
+            self.current_line = None
+            
+            # simplify once more now that the whole line is known
+            line = simplify(coords, self.canvas.doodle_tolerance)
+            self.canvas.Damage(self.GetBoundingBox(coords))
+            if len(line) < 4: # just a click
+                return
+            self.lines.append(line)
+            
+            # it moves from the live layer to the static layer
+            self.canvas.AddToStatic(lambda dc: self.DrawLines(dc, [line]))    
     
-    def Clear(self, event):
-        self.lines = []
-        self.window.Refresh()
+    def Clear(self):
+        """Remove all lines"""
+        self.lines.clear()
+        self.current_line = None
         
 
 #--------------------------------------------------------------------------
 class PlayList():
     """The list of image files to show"""
-    def __init__(self,filename):
-        """Initialize when a file is opened"""
+    def __init__(self,filename, onscan=None):
+        """Initialize when a file is opened.
+        If onscan is given, the directory of an image file is scanned in
+        the background. onscan(playlist, paths, done) is called from the
+        scanning thread with each batch of files found, and the paths
+        have to be added with AddFiles from the main thread"""
         self.playlist = []
         self.nowshowing = 0   #current position in list
         
@@ -1513,22 +2663,78 @@ class PlayList():
         
         # Or an image file (already filtered at selection)
         else:
-            self.CreatePlayList(filename)
+            self.CreatePlayList(filename, onscan)
     
-    def CreatePlayList(self, filename):
+    def CreatePlayList(self, filename, onscan=None):
         """
         Make a playlist by listing all image files in the directory beginning
         from the selected file
         """
         dirname,currentimage = os.path.split(filename)
-        allfiles = os.listdir(dirname)
-                
-        for eachfile in allfiles:
-            if os.path.splitext(eachfile)[1].lower() in ['.bmp','.png',
-                                        '.jpg','.jpeg','.tif','.tiff']:
-                self.playlist.append(os.path.join(dirname,eachfile))
+        self.filename = filename
+        
+        # the selected file is there from the start
+        self.playlist = [filename]
+        self.nowshowing = 0
+        
+        if onscan is None:
+            self.AddFiles([path for path in scan_images(dirname)
+                           if path != filename])
+            return
+        
+        scanner = threading.Thread(target=self.ScanDirectory,
+                                   args=(dirname, onscan))
+        scanner.setDaemon(True)
+        scanner.start()
+    
+    def ScanDirectory(self, dirname, onscan, batchsize=1000, interval=0.5):
+        """Scan the directory, handing over the files found in batches
+        of batchsize or every interval seconds. Runs in its own thread"""
+        batch = []
+        lastbatch = time.time()
+        try:
+            for path in scan_images(dirname):
+                if path != self.filename:
+                    batch.append(path)
+                if len(batch) >= batchsize or (
+                        batch and time.time() - lastbatch > interval):
+                    onscan(self, batch, False)
+                    batch = []
+                    lastbatch = time.time()
+        except (OSError, IOError):
+            pass # keep what has been found
+        onscan(self, batch, True)
+    
+    def AddFiles(self, paths):
+        """Add paths to the playlist, keeping it sorted. The position
+        of the current image is found again by bisection"""
+        current = self.playlist[self.nowshowing]
+        self.playlist.extend(paths)
         self.playlist.sort()
-        self.nowshowing = self.playlist.index(filename)
+        self.nowshowing = bisect_left(self.playlist, current)
+    
+    def Rename(self, position, newpath):
+        """The file at position has been renamed to newpath. A sorted
+        playlist, as made from a directory, is kept sorted, and the
+        position of the current image is found again"""
+        wassorted = self.playlist == sorted(self.playlist)
+        current = self.playlist[self.nowshowing]
+        if current == self.playlist[position]:
+            current = newpath
+        self.playlist[position] = newpath
+        if wassorted:
+            self.playlist.sort()
+        self.nowshowing = self.Find(current)
+    
+    def Find(self, filepath):
+        """Position of filepath in the playlist. A scanned directory is
+        sorted, so it is found by bisection. Playlist files can be in
+        any order"""
+        position = bisect_left(self.playlist, filepath)
+        if position < len(self.playlist) and \
+               self.playlist[position] == filepath:
+            return position
+        return self.playlist.index(filepath)
                         
     def OpenPlaylist(self):
         """open an existing playlist"""
@@ -1542,8 +2748,12 @@ class PlayList():
 class MyApp(wx.App):
     def OnInit(self):
         filepath = None
-        if len(sys.argv) > 1:
-            filepath = sys.argv[1]
+        args = sys.argv[1:]
+        if '--clear-cache' in args:
+            DiskCache(cache_dir(), 0).clear()
+            args.remove('--clear-cache')
+        if args:
+            filepath = args[0]
         if filepath:
             frame = MyFrame(None, _title, filepath)
         else:
@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+
+"""
+Caching and background loading of decoded images.
+Images around the one being shown are decoded by a small pool of
+worker threads so that moving through a playlist does not have to
+wait for the decoder.
+"""
+
+from __future__ import division
+import math
+import threading
+
+from mapped_image import open_mapped
+
+## Pillow fork changes imports, so check for those
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+
+def load_image(filepath, targetsize=None, cropframe=None):
+    """Open and decode the image at filepath.
+    If targetsize (width, height) is given, JPEGs are decoded at the
+    smallest reduced scale (draft mode) at which the part of the image
+    within cropframe still fills targetsize. cropframe is in full
+    resolution pixels. Returns the image and its full resolution size"""
+    image = Image.open(filepath, 'r')
+    fullsize = image.size
+    if targetsize and image.format == 'JPEG':
+        image.draft(image.mode, draft_size(fullsize, targetsize, cropframe))
+    image.load()
+    return image, fullsize
+
+
+def load_region(filepath, frame):
+    """The part of the image at filepath within frame (x1, y1, x2, y2)
+    at full resolution. Uncompressed files are read through a memory
+    map, so only the rows within frame are read"""
+    raster = open_mapped(filepath)
+    if raster is not None:
+        try:
+            return raster.crop(frame)
+        finally:
+            raster.close()
+
+    image = Image.open(filepath, 'r').crop(tuple(frame))
+    image.load()
+    return image
+
+
+def draft_size(fullsize, targetsize, cropframe=None):
+    """Smallest size the whole image can be decoded at so that the
+    part within cropframe fits targetsize, in either orientation,
+    without being scaled up"""
+    fullwidth, fullheight = fullsize
+    if cropframe and list(cropframe) != [0,0,0,0]:
+        x1, y1, x2, y2 = cropframe
+        shownwidth, shownheight = max(x2 - x1, 1), max(y2 - y1, 1)
+    else:
+        shownwidth, shownheight = fullsize
+
+    # image may be rotated, so allow for both orientations
+    targetwidth, targetheight = targetsize
+    scale = max(min(targetwidth / shownwidth, targetheight / shownheight),
+                min(targetheight / shownwidth, targetwidth / shownheight))
+    scale = min(scale, 1)
+
+    return (int(math.ceil(fullwidth * scale)),
+            int(math.ceil(fullheight * scale)))
+
+
+def reduce_image(image, fullsize, targetsize, cropframe=None):
+    """Resize an image decoded from one of fullsize down to the size
+    draft_size asks for, if it is larger. Draft decoding only reduces
+    by powers of two, so the decoded image can be up to twice that"""
+    width, height = draft_size(fullsize, targetsize, cropframe)
+    if image.size[0] <= width or image.size[1] <= height:
+        return image
+    if image.mode not in ('RGB', 'RGBA', 'L'):
+        image = image.convert('RGB')
+    return image.resize((width, height), Image.ANTIALIAS)
+
+
+def scale_frame(frame, reduction):
+    """Convert a frame (x1, y1, x2, y2) in full resolution pixels to
+    pixels of an image reduced by reduction (xreduction, yreduction)"""
+    xreduction, yreduction = reduction
+    x1, y1, x2, y2 = frame
+    return [int(x1 / xreduction), int(y1 / yreduction),
+            int(math.ceil(x2 / xreduction)), int(math.ceil(y2 / yreduction))]
+
+
+def image_data(image):
+    """The raw pixel data of image as a string.
+    Pillow has tobytes, older PIL only tostring"""
+    if hasattr(image, 'tobytes'):
+        return image.tobytes()
+    return image.tostring()
+
+
+def image_cost(image):
+    """Approximate memory used by a decoded image, in bytes"""
+    width, height = image.size
+    return width * height * len(image.getbands())
+
+
+class CachedImage():
+    """A decoded image together with the version prepared for display,
+    that is, cropped and rotated as per the saved image data.
+    The decoded image may be smaller than the full resolution size"""
+    def __init__(self, uncropped_image, image, cropframe, rotation, fullsize):
+        self.uncropped_image = uncropped_image
+        self.image = image
+        self.cropframe = list(cropframe)
+        self.rotation = rotation % 4
+        self.fullsize = fullsize
+
+        # full resolution pixels per decoded pixel along x and y
+        width, height = uncropped_image.size
+        self.reduction = (fullsize[0] / width, fullsize[1] / height)
+
+    def cost(self):
+        """Memory used by the images held"""
+        cost = image_cost(self.uncropped_image)
+        if self.image is not self.uncropped_image:
+            cost += image_cost(self.image)
+        return cost
+
+
+class LRUCache():
+    """A bounded cache that discards the least recently used entries
+    when full. Size is the number of entries or, if costfunction
+    is given, the sum of costfunction(value) over all the entries"""
+    def __init__(self, maxsize, costfunction=None):
+        self.maxsize = maxsize
+        self.costfunction = costfunction
+
+        self.entries = {}
+        self.costs = {}
+        self.order = [] # least recently used first
+        self.totalcost = 0
+
+        # counters for lookups
+        self.hits = 0
+        self.misses = 0
+
+        self.lock = threading.RLock()
+
+    def __contains__(self, key):
+        """Membership test - does not count as a use of the entry"""
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        """Return the entry for key and mark it as recently used"""
+        self.lock.acquire()
+        try:
+            if key in self.entries:
+                self.hits += 1
+                self.order.remove(key)
+                self.order.append(key)
+                return self.entries[key]
+            else:
+                self.misses += 1
+                return default
+        finally:
+            self.lock.release()
+
+    def put(self, key, value):
+        """Add or replace an entry, evicting old ones if needed.
+        Entries larger than the whole cache are not stored"""
+        if self.costfunction:
+            cost = self.costfunction(value)
+        else:
+            cost = 1
+
+        self.lock.acquire()
+        try:
+            self.remove(key)
+            if cost > self.maxsize:
+                return
+
+            while self.order and self.totalcost + cost > self.maxsize:
+                self.remove(self.order[0])
+
+            self.entries[key] = value
+            self.costs[key] = cost
+            self.order.append(key)
+            self.totalcost += cost
+        finally:
+            self.lock.release()
+
+    def remove(self, key):
+        """Remove the entry for key if present"""
+        self.lock.acquire()
+        try:
+            if key in self.entries:
+                del self.entries[key]
+                self.totalcost -= self.costs.pop(key)
+                self.order.remove(key)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        """Remove all entries"""
+        self.lock.acquire()
+        try:
+            self.entries = {}
+            self.costs = {}
+            self.order = []
+            self.totalcost = 0
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """Return (hits, misses, number of entries, total cost)"""
+        return (self.hits, self.misses, len(self.entries), self.totalcost)
+
+
+class Prefetcher():
+    """A pool of worker threads that fill a cache in the background.
+    loader is called with a key and returns the value to be cached"""
+    def __init__(self, cache, loader, workers=2):
+        self.cache = cache
+        self.loader = loader
+
+        self.pending = []       # keys waiting to be loaded, most urgent first
+        self.inprogress = set() # keys being loaded by a worker
+        self.condition = threading.Condition()
+
+        for n in range(workers):
+            worker = threading.Thread(target=self._work)
+            worker.setDaemon(True) # do not hold up exit
+            worker.start()
+
+    def prefetch(self, keys):
+        """Replace the waiting requests with keys, most urgent first.
+        Keys already cached or being loaded are skipped"""
+        self.condition.acquire()
+        try:
+            self.pending = [key for key in keys if key not in self.cache
+                            and key not in self.inprogress]
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def get(self, key):
+        """Return the value for key, from the cache if possible.
+        If a worker is already loading it, wait for the worker,
+        otherwise load it in the calling thread. Returns None if
+        the value could not be loaded"""
+        self.condition.acquire()
+        try:
+            while key in self.inprogress:
+                self.condition.wait()
+            if key in self.pending:
+                self.pending.remove(key)
+        finally:
+            self.condition.release()
+
+        # possibly finished by a worker while we were waiting
+        value = self.cache.get(key)
+        if value is not None:
+            return value
+
+        try:
+            value = self.loader(key)
+        except Exception:
+            return None
+        self.cache.put(key, value)
+        return value
+
+    def _work(self):
+        """Worker loop - load pending keys one at a time"""
+        while True:
+            self.condition.acquire()
+            try:
+                while not self.pending:
+                    self.condition.wait()
+                key = self.pending.pop(0)
+                self.inprogress.add(key)
+            finally:
+                self.condition.release()
+
+            try:
+                try:
+                    self.cache.put(key, self.loader(key))
+                except Exception:
+                    pass # will be retried in the foreground when needed
+            finally:
+                self.condition.acquire()
+                self.inprogress.discard(key)
+                self.condition.notifyAll()
+                self.condition.release()
+
+
+class Resampler():
+    """A background thread for high quality resizing. Only the latest
+    request is kept, older ones that have not started are dropped.
+    callback(key, resizedimage) is called from the worker thread"""
+    def __init__(self, callback):
+        self.callback = callback
+        self.request = None # (key, image, size)
+        self.condition = threading.Condition()
+
+        worker = threading.Thread(target=self._work)
+        worker.setDaemon(True)
+        worker.start()
+
+    def resample(self, key, image, size):
+        """Request an antialiased resize of image to size"""
+        self.condition.acquire()
+        try:
+            self.request = (key, image, size)
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def _work(self):
+        """Worker loop - resize the latest request"""
+        while True:
+            self.condition.acquire()
+            try:
+                while self.request is None:
+                    self.condition.wait()
+                key, image, size = self.request
+                self.request = None
+            finally:
+                self.condition.release()
+
+            try:
+                resizedimage = image.resize(size, Image.ANTIALIAS)
+            except Exception:
+                continue # the preview stays
+            self.callback(key, resizedimage)
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+
+"""
+Reading uncompressed TIFF and BMP files through a memory map.
+Recording systems export long strips as uncompressed rasters of
+hundreds of MB. Decoding these with PIL holds the whole raster in
+memory, but as the pixels are stored as plain rows, any part of the
+image can be read straight from the file. Here only the rows of a crop
+are read, and reduced views are made a band of rows at a time, so
+memory use stays near the size of the result.
+"""
+
+from __future__ import division
+import os
+import mmap
+import struct
+
+## Pillow fork changes imports, so check for those
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+
+class UnsupportedLayout(Exception):
+    """The file is not an uncompressed raster that can be mapped"""
+    pass
+
+
+class MappedRaster():
+    """An uncompressed raster image read through a memory map.
+    Rows are stored in strips, each strip at stripoffsets[n] holding
+    rowsperstrip rows of stride bytes. If bottomup is true, the first
+    row stored is the bottom row of the image"""
+    def __init__(self, filepath, parser):
+        self.file = open(filepath, 'rb')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        except Exception:
+            self.file.close()
+            raise
+        try:
+            parser(self)
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        """Release the map and the file"""
+        self.map.close()
+        self.file.close()
+
+    def unpack(self, format, offset):
+        """Unpack values from the file at offset"""
+        return struct.unpack(format,
+                             self.map[offset:offset + struct.calcsize(format)])
+
+    def row_offset(self, y):
+        """Position in the file of row y"""
+        if self.bottomup:
+            y = self.size[1] - 1 - y
+        return (self.stripoffsets[y // self.rowsperstrip] +
+                (y % self.rowsperstrip) * self.stride)
+
+    def clip(self, frame):
+        """Limit a frame (x1, y1, x2, y2) to the image"""
+        width, height = self.size
+        if not frame or list(frame) == [0,0,0,0]:
+            return 0, 0, width, height
+        x1, y1, x2, y2 = [int(coord) for coord in frame]
+        x1, x2 = max(0, min(x1, width - 1)), max(1, min(x2, width))
+        y1, y2 = max(0, min(y1, height - 1)), max(1, min(y2, height))
+        return x1, y1, max(x2, x1 + 1), max(y2, y1 + 1)
+
+    def crop(self, frame):
+        """The part of the image within frame, at full resolution"""
+        x1, y1, x2, y2 = self.clip(frame)
+        start, end = x1 * self.pixelbytes, x2 * self.pixelbytes
+        rows = []
+        for y in range(y1, y2):
+            offset = self.row_offset(y)
+            rows.append(self.map[offset + start:offset + end])
+
+        image = Image.frombuffer(self.mode, (x2 - x1, y2 - y1),
+                                 ''.join(rows), 'raw', self.rawmode, 0, 1)
+        if self.palette:
+            image.putpalette(self.palette)
+        return image
+
+    def reduced(self, size, frame=None, bandbytes=16*1024*1024):
+        """The part of the image within frame resized to size.
+        The rows are read and resized in bands of about bandbytes,
+        so the whole region is never in memory"""
+        x1, y1, x2, y2 = self.clip(frame)
+        width, height = size
+        if (width, height) == (x2 - x1, y2 - y1):
+            return self.crop(frame)
+        
+        rowbytes = (x2 - x1) * self.pixelbytes
+        rowsperoutput = (y2 - y1) / height # rows read for each row made
+
+        bandrows = max(1, int(bandbytes / (rowbytes * max(rowsperoutput, 1))))
+        if self.mode == 'P':
+            result = Image.new('RGB', size)
+        else:
+            result = Image.new(self.mode, size)
+
+        for outy in range(0, height, bandrows):
+            outrows = min(bandrows, height - outy)
+            top = y1 + int(round(outy * rowsperoutput))
+            bottom = y1 + int(round((outy + outrows) * rowsperoutput))
+            bottom = max(top + 1, min(bottom, y2))
+
+            band = self.crop((x1, top, x2, bottom))
+            if band.mode == 'P':
+                band = band.convert('RGB') # cannot be resampled
+            result.paste(band.resize((width, outrows), Image.ANTIALIAS),
+                         (0, outy))
+        return result
+
+
+## transposes for rotation by quarter turns clockwise
+transposes = {1: Image.ROTATE_270, 2: Image.ROTATE_180, 3: Image.ROTATE_90}
+
+
+class MappedView():
+    """The part of a MappedRaster within frame, rotated by rotation
+    quarter turns clockwise, as an image is prepared for display.
+    Parts of it are read with crop, so it can stand in for the image
+    at full resolution where only some of it is needed at a time"""
+    def __init__(self, raster, frame, rotation):
+        self.raster = raster
+        self.frame = raster.clip(frame)
+        self.rotation = rotation % 4
+        self.mode = raster.mode
+
+        x1, y1, x2, y2 = self.frame
+        if self.rotation % 2:
+            self.size = (y2 - y1, x2 - x1)
+        else:
+            self.size = (x2 - x1, y2 - y1)
+
+    def close(self):
+        """Release the raster"""
+        self.raster.close()
+
+    def region(self, frame):
+        """The frame in the raster of the part of the
+        view within frame (x1, y1, x2, y2)"""
+        x1, y1, x2, y2 = frame
+        left, top, right, bottom = self.frame
+        width, height = right - left, bottom - top
+
+        # the same part of the unrotated region
+        if self.rotation == 0:
+            region = (x1, y1, x2, y2)
+        elif self.rotation == 1:
+            region = (y1, height - x2, y2, height - x1)
+        elif self.rotation == 2:
+            region = (width - x2, height - y2, width - x1, height - y1)
+        else:
+            region = (width - y2, x1, width - y1, x2)
+        return (left + region[0], top + region[1],
+                left + region[2], top + region[3])
+
+    def rotate(self, image):
+        """Rotate a part read from the raster as the view is"""
+        if self.rotation:
+            image = image.transpose(transposes[self.rotation])
+        return image
+
+    def crop(self, frame):
+        """The part of the view within frame (x1, y1, x2, y2)"""
+        return self.rotate(self.raster.crop(self.region(frame)))
+
+    def reduced(self, size, frame):
+        """The part of the view within frame resized to size. Read
+        a band at a time, see MappedRaster.reduced"""
+        width, height = size
+        if self.rotation % 2:
+            width, height = height, width
+        return self.rotate(self.raster.reduced((width, height),
+                                               self.region(frame)))
+
+
+def parse_bmp(raster):
+    """Read the layout of an uncompressed BMP"""
+    if raster.map[0:2] != 'BM':
+        raise UnsupportedLayout('not a BMP')
+    dataoffset, = raster.unpack('<I', 10)
+    headersize, width, height = raster.unpack('<Iii', 14)
+    planes, bitcount, compression = raster.unpack('<HHI', 26)
+    if headersize < 40 or compression != 0 or width <= 0 or height == 0:
+        raise UnsupportedLayout('compressed or old style BMP')
+
+    raster.palette = None
+    if bitcount == 24:
+        raster.mode, raster.rawmode = 'RGB', 'BGR'
+    elif bitcount == 32:
+        raster.mode, raster.rawmode = 'RGB', 'BGRX'
+    elif bitcount == 8:
+        raster.mode, raster.rawmode = 'P', 'P'
+        colors, = raster.unpack('<I', 46)
+        colors = colors or 256
+        table = raster.map[14 + headersize:14 + headersize + 4 * colors]
+        raster.palette = []
+        for index in range(0, len(table), 4):
+            blue, green, red = [ord(byte) for byte in table[index:index + 3]]
+            raster.palette.extend((red, green, blue))
+    else:
+        raise UnsupportedLayout('%d bit BMP' % bitcount)
+
+    raster.size = (width, abs(height))
+    raster.pixelbytes = bitcount // 8
+    raster.stride = ((bitcount * width + 31) // 32) * 4 # rows padded to 4
+    raster.bottomup = height > 0
+    raster.rowsperstrip = abs(height)
+    raster.stripoffsets = [dataoffset]
+
+    if dataoffset + raster.stride * abs(height) > len(raster.map):
+        raise UnsupportedLayout('truncated BMP')
+
+
+def parse_tiff(raster):
+    """Read the layout of an uncompressed 8 bit grayscale or RGB TIFF"""
+    byteorder = raster.map[0:2]
+    if byteorder == 'II':
+        order = '<'
+    elif byteorder == 'MM':
+        order = '>'
+    else:
+        raise UnsupportedLayout('not a TIFF')
+    magic, ifdoffset = raster.unpack(order + 'HI', 2)
+    if magic != 42:
+        raise UnsupportedLayout('not a TIFF') # eg. BigTIFF
+
+    # read the tags of the first image
+    typesizes = {1: 'B', 3: 'H', 4: 'I'}
+    needed = (256, 257, 258, 259, 262, 273, 277, 278, 284, 322)
+    tags = {}
+    count, = raster.unpack(order + 'H', ifdoffset)
+    for entry in range(count):
+        position = ifdoffset + 2 + 12 * entry
+        tag, type, valuecount = raster.unpack(order + 'HHI', position)
+        if tag not in needed or type not in typesizes:
+            continue # not a tag needed for the layout
+        format = order + typesizes[type] * valuecount
+        if struct.calcsize(format) > 4:
+            position, = raster.unpack(order + 'I', position + 8)
+        else:
+            position += 8
+        tags[tag] = raster.unpack(format, position)
+
+    width, = tags[256]
+    height, = tags[257]
+    samples = tags.get(277, (1,))[0]
+    bits = tags.get(258, (1,) * samples)
+    compression = tags.get(259, (1,))[0]
+    photometric = tags.get(262, (None,))[0]
+    planar = tags.get(284, (1,))[0]
+    if compression != 1 or planar != 1 or 322 in tags:
+        raise UnsupportedLayout('compressed, planar or tiled TIFF')
+    if [bit for bit in bits if bit != 8]:
+        raise UnsupportedLayout('TIFF with %s bits' % (bits,))
+
+    raster.palette = None
+    if samples == 1 and photometric == 1:
+        raster.mode = raster.rawmode = 'L'
+    elif samples == 3 and photometric == 2:
+        raster.mode = raster.rawmode = 'RGB'
+    else:
+        raise UnsupportedLayout('TIFF with %d samples' % samples)
+
+    raster.size = (width, height)
+    raster.pixelbytes = samples
+    raster.stride = width * samples
+    raster.bottomup = False
+    raster.rowsperstrip = min(tags.get(278, (height,))[0], height)
+    raster.stripoffsets = list(tags[273])
+
+    strips = (height + raster.rowsperstrip - 1) // raster.rowsperstrip
+    if len(raster.stripoffsets) < strips:
+        raise UnsupportedLayout('missing TIFF strips')
+    for strip, offset in enumerate(raster.stripoffsets[:strips]):
+        rows = min(raster.rowsperstrip, height - strip * raster.rowsperstrip)
+        if offset + rows * raster.stride > len(raster.map):
+            raise UnsupportedLayout('truncated TIFF')
+
+
+parsers = {'.bmp': parse_bmp, '.tif': parse_tiff, '.tiff': parse_tiff}
+
+
+def open_mapped(filepath):
+    """Open filepath as a MappedRaster if it is an uncompressed
+    raster that can be mapped, otherwise return None"""
+    parser = parsers.get(os.path.splitext(filepath)[1].lower())
+    if parser is None:
+        return None
+    try:
+        return MappedRaster(filepath, parser)
+    except Exception: # includes UnsupportedLayout
+        return None
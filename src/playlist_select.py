@@ -11,7 +11,7 @@ a base list or an empty list. """
 ## Drag n drop implementation is from the wxpython wiki - http://wiki.wxpython.org/ListControls
 ###################
 
-import wx, os, sys
+import wx, os
 import string
 from geticons import getBitmap
 
@@ -100,6 +100,24 @@ class ListDrop(wx.PyDropTarget):
         return d
 
 
+class PlayListCtrl(wx.ListCtrl):
+    """Virtual list showing the path and name of each file in
+    a playlist. Rows are made from the paths only when shown"""
+    def __init__(self, parent, id, style=0):
+        wx.ListCtrl.__init__(self, parent, id, style=style|wx.LC_VIRTUAL)
+        self.paths = []
+
+    def ShowPaths(self):
+        """Show the current paths"""
+        self.SetItemCount(len(self.paths))
+        self.Refresh()
+
+    def OnGetItemText(self, item, column):
+        if column == 0:
+            return self.paths[item]
+        return os.path.basename(self.paths[item])
+
+
 class PlayListSelector(wx.Dialog):
     def __init__(self, parent, playlist=[]):
         """playlist_selector is a dialog for constructing the playlist.
@@ -110,7 +128,7 @@ class PlayListSelector(wx.Dialog):
                                     wx.TAB_TRAVERSAL)
         self.listpanel = wx.Panel(self, -1, style=wx.SUNKEN_BORDER)
         
-        self.playlistctrl = wx.ListCtrl(self.listpanel, -1, style=wx.LC_REPORT|
+        self.playlistctrl = PlayListCtrl(self.listpanel, -1, style=wx.LC_REPORT|
                                         wx.LC_SINGLE_SEL | wx.SUNKEN_BORDER)
         # self.playlistctrl = DragList(self.listpanel, -1,  style=wx.LC_REPORT|
         #                              wx.LC_SINGLE_SEL | wx.SUNKEN_BORDER)
@@ -196,13 +214,15 @@ class PlayListSelector(wx.Dialog):
         
     def loadPlaylist(self, playlist):
         """Load an existing playlist for editing"""
-        for path in playlist:
-            index = self.playlistctrl.InsertStringItem(sys.maxint,path)
-            self.playlistctrl.SetStringItem(index, 1, os.path.basename(path))
+        self.playlistctrl.paths.extend(playlist)
+        self.playlistctrl.ShowPaths()
         
     def removeItem(self, event): # wxGlade: Frame.<event_handler>
         selection = self.playlistctrl.GetFirstSelected()
-        self.playlistctrl.DeleteItem(selection)
+        if selection == -1: # nothing selected
+            return
+        del self.playlistctrl.paths[selection]
+        self.playlistctrl.ShowPaths()
 
     def moveUp(self, event): # wxGlade: Frame.<event_handler>
         selection = self.playlistctrl.GetFirstSelected()
@@ -222,18 +242,16 @@ class PlayListSelector(wx.Dialog):
 
     def moveLocation(self, current_location, new_location):
         """Move entry in playlist to new location"""
-        path = self.playlistctrl.GetItemText(current_location)
-        self.playlistctrl.DeleteItem(current_location)
-        
-        self.playlistctrl.InsertStringItem(new_location, path)
-        self.playlistctrl.SetStringItem(new_location, 1, os.path.basename(path))
+        if current_location == -1: # nothing selected
+            return
+        paths = self.playlistctrl.paths
+        paths.insert(new_location, paths.pop(current_location))
+        self.playlistctrl.ShowPaths()
         self.playlistctrl.SetItemState(new_location, wx.LIST_STATE_SELECTED,
                                        wx.LIST_STATE_SELECTED)
 
     def savePlaylist(self, event): # wxGlade: Frame.<event_handler>
-        self.playlist = [] # start with clear list
-        for index in range(self.playlistctrl.GetItemCount()):
-            self.playlist.append(self.playlistctrl.GetItemText(index))
+        self.playlist = list(self.playlistctrl.paths)
         
         dlg = wx.FileDialog(self, "Save playlist as...",
                                     style=wx.SAVE | wx.OVERWRITE_PROMPT,
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+"""
+Compact storage for doodle strokes.
+All points of all strokes are kept in one typed array of world coords
+(x0, y0, x1, y1, ...) with the index of the first point of each stroke
+in a second array. This takes 8 bytes per point compared to over a
+hundred for lists of segment tuples.
+Strokes are also simplified as they are drawn, dropping points that
+add nothing visible.
+"""
+
+from __future__ import division
+import sys
+import math
+import struct
+from array import array
+
+from annotation_store import FormatError
+
+
+class StrokeList():
+    """A list of polylines stored in flat arrays"""
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        """Remove all strokes"""
+        self.coords = array('f') # x and y of every point
+        self.starts = array('l') # index of first point of each stroke
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __nonzero__(self):
+        return len(self.starts) > 0
+
+    def __iter__(self):
+        """Iterate over the strokes, each as an array x0, y0, x1, y1..."""
+        for index in range(len(self.starts)):
+            yield self.stroke(index)
+
+    def stroke(self, index):
+        """The coords of one stroke"""
+        start = self.starts[index] * 2
+        if index + 1 < len(self.starts):
+            end = self.starts[index + 1] * 2
+        else:
+            end = len(self.coords)
+        return self.coords[start:end]
+
+    def append(self, coords):
+        """Add a stroke given as a sequence x0, y0, x1, y1..."""
+        self.starts.append(len(self.coords) // 2)
+        self.coords.extend(coords)
+
+    def tostring(self):
+        """Compact encoding for saving - the number of strokes, the
+        start of each stroke and then all the coords, little endian"""
+        starts = array('i', self.starts)
+        coords = array('f', self.coords)
+        if sys.byteorder == 'big':
+            starts.byteswap()
+            coords.byteswap()
+        return (struct.pack('<I', len(starts)) + starts.tostring() +
+                coords.tostring())
+
+    def fromstring(cls, data):
+        """Make a StrokeList from the encoding made by tostring.
+        Raises FormatError if data is not such an encoding"""
+        if not isinstance(data, str) or len(data) < 4:
+            raise FormatError("damaged doodle")
+        count, = struct.unpack('<I', data[:4])
+        # starts are 4 bytes each, then 8 bytes for each point
+        if len(data) < 4 + 4 * count or (len(data) - 4 - 4 * count) % 8:
+            raise FormatError("damaged doodle")
+        starts = array('i')
+        starts.fromstring(data[4:4 + 4 * count])
+        coords = array('f')
+        coords.fromstring(data[4 + 4 * count:])
+        if sys.byteorder == 'big':
+            starts.byteswap()
+            coords.byteswap()
+        if list(starts) != sorted(starts) or (starts and (
+                starts[0] != 0 or starts[-1] > len(coords) // 2)):
+            raise FormatError("damaged doodle")
+
+        strokes = cls()
+        strokes.starts = array('l', starts)
+        strokes.coords = coords
+        return strokes
+    fromstring = classmethod(fromstring)
+
+
+def segment_distance(x, y, x1, y1, x2, y2):
+    """Distance of point x, y from the segment x1, y1 - x2, y2"""
+    dx, dy = x2 - x1, y2 - y1
+    length2 = dx * dx + dy * dy
+    if length2 == 0:
+        return math.hypot(x - x1, y - y1)
+
+    # position of the nearest point along the segment, 0 to 1
+    t = ((x - x1) * dx + (y - y1) * dy) / length2
+    t = max(0, min(1, t))
+    return math.hypot(x - (x1 + t * dx), y - (y1 + t * dy))
+
+
+def simplify(coords, tolerance):
+    """Douglas-Peucker simplification of a polyline x0, y0, x1, y1...
+    Points are dropped as long as the line stays within tolerance
+    of every original point. Returns a new array"""
+    npoints = len(coords) // 2
+    if npoints < 3 or tolerance <= 0:
+        return array('f', coords)
+
+    keep = [False] * npoints
+    keep[0] = keep[-1] = True
+    stack = [(0, npoints - 1)]
+    while stack:
+        first, last = stack.pop()
+        x1, y1 = coords[2 * first], coords[2 * first + 1]
+        x2, y2 = coords[2 * last], coords[2 * last + 1]
+
+        # farthest point from the line between first and last
+        maxdistance, farthest = 0, None
+        for index in range(first + 1, last):
+            distance = segment_distance(coords[2 * index],
+                                        coords[2 * index + 1],
+                                        x1, y1, x2, y2)
+            if distance > maxdistance:
+                maxdistance, farthest = distance, index
+
+        if farthest is not None and maxdistance > tolerance:
+            keep[farthest] = True
+            stack.append((first, farthest))
+            stack.append((farthest, last))
+
+    simplified = array('f')
+    for index in range(npoints):
+        if keep[index]:
+            simplified.extend(coords[2 * index:2 * index + 2])
+    return simplified
+
+
+class StrokeSimplifier():
+    """Simplifies a stroke while it is being drawn.
+    A new point is dropped if it is within tolerance of the last point
+    kept. The last point kept is replaced by the new one if it, and the
+    points it replaced earlier, are all within tolerance of the straight
+    line to the new point"""
+    def __init__(self, x, y, tolerance):
+        self.coords = array('f', (x, y))
+        self.tolerance = tolerance
+        self.replaced = [] # points between the last two points kept
+
+    def add(self, x, y):
+        """Add a point to the stroke"""
+        coords = self.coords
+        lastx, lasty = coords[-2], coords[-1]
+        if self.tolerance <= 0:
+            coords.extend((x, y))
+            return
+
+        if math.hypot(x - lastx, y - lasty) < self.tolerance:
+            return
+
+        if len(coords) >= 4:
+            anchorx, anchory = coords[-4], coords[-3]
+            candidates = self.replaced + [(lastx, lasty)]
+            for pointx, pointy in candidates:
+                if segment_distance(pointx, pointy, anchorx, anchory,
+                                    x, y) > self.tolerance:
+                    break
+            else:
+                # straight enough - extend the last segment
+                self.replaced = candidates
+                coords[-2], coords[-1] = x, y
+                return
+            self.replaced = []
+
+        coords.extend((x, y))
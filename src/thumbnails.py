@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+"""
+Thumbnails of the images in a playlist.
+Thumbnails are made by a pool of worker threads, decoding at reduced
+scale where possible, and are kept in the disk cache so that a
+playlist is only thumbnailed once.
+"""
+
+from __future__ import division
+import threading
+
+from image_cache import load_image, reduce_image
+from mapped_image import open_mapped
+
+## Pillow fork changes imports, so check for those
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+
+def fit_size(fullsize, size):
+    """Size of an image of fullsize reduced to fit a square of size"""
+    width, height = fullsize
+    scale = min(size / width, size / height, 1)
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+def make_thumbnail(filepath, size, diskcache=None):
+    """A thumbnail of the image at filepath, centered in a white
+    square of size pixels"""
+    variant = 'thumbnail %d' % size
+    if diskcache:
+        stored = diskcache.get(filepath, variant)
+        if stored:
+            return stored[0]
+
+    raster = open_mapped(filepath)
+    if raster is not None:
+        try:
+            fullsize = raster.size
+            image = raster.reduced(fit_size(fullsize, size))
+        finally:
+            raster.close()
+    else:
+        image, fullsize = load_image(filepath, (size, size))
+        image = reduce_image(image, fullsize, (size, size))
+
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    if image.size != fit_size(image.size, size):
+        image = image.resize(fit_size(image.size, size), Image.ANTIALIAS)
+
+    thumbnail = Image.new('RGB', (size, size), 'white')
+    width, height = image.size
+    thumbnail.paste(image, ((size - width) // 2, (size - height) // 2))
+
+    if diskcache:
+        diskcache.put(filepath, variant, thumbnail, fullsize)
+    return thumbnail
+
+
+class ThumbnailMaker():
+    """A pool of worker threads making thumbnails for a list of files.
+    callback(generation, position, thumbnail) is called from a worker
+    thread as each one is done, with thumbnail None if it failed.
+    Starting on a new list drops what is left of the old one, and the
+    generation tells results for the old list apart"""
+    def __init__(self, callback, size, diskcache=None, workers=2):
+        self.callback = callback
+        self.size = size
+        self.diskcache = diskcache
+
+        self.generation = 0
+        self.pending = [] # (position, filepath), first is done first
+        self.condition = threading.Condition()
+
+        for n in range(workers):
+            worker = threading.Thread(target=self._work)
+            worker.setDaemon(True) # do not hold up exit
+            worker.start()
+
+    def start(self, filepaths, first=0):
+        """Make thumbnails for filepaths, beginning from position first.
+        Returns the generation of the results"""
+        self.condition.acquire()
+        try:
+            self.generation += 1
+            order = range(first, len(filepaths)) + range(0, first)
+            self.pending = [(position, filepaths[position])
+                            for position in order]
+            self.condition.notifyAll()
+            return self.generation
+        finally:
+            self.condition.release()
+
+    def _work(self):
+        """Worker loop - make pending thumbnails one at a time"""
+        while True:
+            self.condition.acquire()
+            try:
+                while not self.pending:
+                    self.condition.wait()
+                position, filepath = self.pending.pop(0)
+                generation = self.generation
+            finally:
+                self.condition.release()
+
+            try:
+                thumbnail = make_thumbnail(filepath, self.size,
+                                           self.diskcache)
+            except Exception:
+                thumbnail = None
+            self.callback(generation, position, thumbnail)
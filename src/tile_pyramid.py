@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+
+"""
+Multi-resolution tile pyramid for zooming into large images.
+Level 0 is the image itself, each level above it is half the size of
+the one below. Every level is cut into square tiles, and tiles are only
+made when they are asked for - a level 0 tile is cropped from the image
+and a tile at a higher level is made by halving the four tiles below it.
+So only the part of the image being viewed is ever resampled.
+The image can also be a MappedView, then tiles are read from the file
+and the whole image is never in memory.
+A large image comes with a smaller preview of it. Tiles at levels
+with no more detail than the preview are cut from the preview, and
+finer tiles are made by a TileMaker in the background, with the
+preview drawn in their place until they are ready.
+"""
+
+from __future__ import division
+import math
+import threading
+
+from image_cache import LRUCache, image_cost
+
+## Pillow fork changes imports, so check for those
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+
+class TilePyramid():
+    """Tiles of image at successively halved resolutions. image is
+    a PIL image or anything else with size, mode and crop(frame).
+    preview is a smaller version of image, or None if the image is
+    small enough for all tiles to be made at once.
+    Tiles made are kept in a cache of cachesize bytes"""
+    def __init__(self, image, tilesize=256, cachesize=64*1024*1024,
+                 preview=None):
+        self.image = image
+        self.preview = preview
+        # resampling needs a continuous tone mode
+        if image.mode in ('RGB', 'L'):
+            self.mode = image.mode
+        else:
+            self.mode = 'RGB'
+
+        self.tilesize = tilesize
+        self.cache = LRUCache(cachesize, image_cost)
+
+        # highest level is the first that fits in a single tile
+        self.maxlevel = 0
+        while max(self.level_size(self.maxlevel)) > tilesize:
+            self.maxlevel += 1
+
+        # first level with no more detail than the preview
+        self.previewlevel = 0
+        if preview is not None:
+            previewscale = preview.size[0] / image.size[0]
+            while self.previewlevel < self.maxlevel and \
+                      0.5 ** self.previewlevel > previewscale:
+                self.previewlevel += 1
+
+    def level_size(self, level):
+        """Size in pixels of the image at level"""
+        width, height = self.image.size
+        return (int(math.ceil(width / 2 ** level)),
+                int(math.ceil(height / 2 ** level)))
+
+    def level_for(self, scale):
+        """The highest level that still has at least as many pixels
+        as needed to show the image at scale (display pixels per
+        image pixel)"""
+        level = 0
+        while level < self.maxlevel and scale <= 0.5 ** (level + 1):
+            level += 1
+        return level
+
+    def tiles_in(self, level, rect):
+        """The (column, row) of the tiles at level that overlap rect
+        (x1, y1, x2, y2), given in image pixels"""
+        width, height = self.image.size
+        span = self.tilesize * 2 ** level # image pixels covered by a tile
+        x1, y1, x2, y2 = rect
+        firstcol, firstrow = int(max(x1, 0) // span), int(max(y1, 0) // span)
+        lastcol = int(math.ceil(min(x2, width) / span))
+        lastrow = int(math.ceil(min(y2, height) / span))
+        return [(col, row) for row in range(firstrow, lastrow)
+                for col in range(firstcol, lastcol)]
+
+    def tile_frame(self, level, col, row):
+        """The frame (x1, y1, x2, y2) of a tile in pixels of its level"""
+        levelwidth, levelheight = self.level_size(level)
+        x1, y1 = col * self.tilesize, row * self.tilesize
+        return (x1, y1, min(x1 + self.tilesize, levelwidth),
+                min(y1 + self.tilesize, levelheight))
+
+    def tile_rect(self, level, col, row):
+        """The frame (x1, y1, x2, y2) of a tile in image pixels"""
+        width, height = self.image.size
+        x1, y1, x2, y2 = self.tile_frame(level, col, row)
+        scale = 2 ** level
+        return (x1 * scale, y1 * scale,
+                min(x2 * scale, width), min(y2 * scale, height))
+
+    def ready(self, level, col, row):
+        """The image for a tile if it can be had at once - it is
+        cached or cut from the preview. Otherwise None, and the tile
+        should be made in the background"""
+        tile = self.cache.get((level, col, row))
+        if tile is None and (self.preview is None or
+                             level >= self.previewlevel):
+            tile = self.tile(level, col, row)
+        return tile
+
+    def from_preview(self, level, col, row):
+        """The part of the preview covering a tile, at the size of the
+        tile. Coarser than the tile if level is below previewlevel"""
+        previewwidth, previewheight = self.preview.size
+        width, height = self.image.size
+        x1, y1, x2, y2 = self.tile_rect(level, col, row)
+        scalex, scaley = previewwidth / width, previewheight / height
+        left, top = int(x1 * scalex), int(y1 * scaley)
+        right = max(left + 1, min(int(math.ceil(x2 * scalex)), previewwidth))
+        bottom = max(top + 1, min(int(math.ceil(y2 * scaley)), previewheight))
+
+        part = self.preview.crop((left, top, right, bottom))
+        if part.mode != self.mode:
+            part = part.convert(self.mode)
+        x1, y1, x2, y2 = self.tile_frame(level, col, row)
+        return part.resize((x2 - x1, y2 - y1), Image.ANTIALIAS)
+
+    def tile(self, level, col, row):
+        """The image for a tile, made if not already cached"""
+        key = (level, col, row)
+        tile = self.cache.get(key)
+        if tile is not None:
+            return tile
+
+        x1, y1, x2, y2 = self.tile_frame(level, col, row)
+        if self.preview is not None and level >= self.previewlevel:
+            tile = self.from_preview(level, col, row)
+
+        elif level == 0:
+            tile = self.image.crop((x1, y1, x2, y2))
+            if tile.mode != self.mode:
+                tile = tile.convert(self.mode)
+            else:
+                tile.load() # crop is lazy, do not keep a reference to image
+
+        elif hasattr(self.image, 'reduced'):
+            # read and reduce a band at a time
+            tile = self.image.reduced((x2 - x1, y2 - y1),
+                                      self.tile_rect(level, col, row))
+            if tile.mode != self.mode:
+                tile = tile.convert(self.mode)
+
+        else:
+            # paste the (up to) four tiles below and halve them
+            below = level - 1
+            belowwidth, belowheight = self.level_size(below)
+            tilesize = self.tilesize
+            width = min(2 * x2, belowwidth) - 2 * x1
+            height = min(2 * y2, belowheight) - 2 * y1
+            combined = Image.new(self.mode, (width, height))
+            for dx in (0, 1):
+                for dy in (0, 1):
+                    if (2 * col + dx) * tilesize >= belowwidth or \
+                       (2 * row + dy) * tilesize >= belowheight:
+                        continue
+                    combined.paste(self.tile(below, 2 * col + dx,
+                                             2 * row + dy),
+                                   (dx * tilesize, dy * tilesize))
+            tile = combined.resize((x2 - x1, y2 - y1), Image.ANTIALIAS)
+
+        self.cache.put(key, tile)
+        return tile
+
+
+class TileMaker():
+    """A worker thread making tiles of pyramids in the background.
+    callback(pyramid, level, col, row) is called from the worker
+    thread as each tile is made"""
+    def __init__(self, callback):
+        self.callback = callback
+        self.pending = [] # (pyramid, level, col, row), first is made first
+        self.condition = threading.Condition()
+
+        worker = threading.Thread(target=self._work)
+        worker.setDaemon(True) # do not hold up exit
+        worker.start()
+
+    def request(self, pyramid, tiles):
+        """Make tiles, a list of (level, col, row) of pyramid. Tiles
+        requested before and not made yet are dropped, as they are
+        no longer in view"""
+        self.condition.acquire()
+        try:
+            self.pending = [(pyramid,) + tile for tile in tiles]
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def _work(self):
+        """Worker loop - make pending tiles one at a time"""
+        while True:
+            self.condition.acquire()
+            try:
+                while not self.pending:
+                    self.condition.wait()
+                pyramid, level, col, row = self.pending.pop(0)
+            finally:
+                self.condition.release()
+
+            try:
+                pyramid.tile(level, col, row)
+            except Exception: # eg. the file has been closed
+                continue
+            self.callback(pyramid, level, col, row)